@@ -38,6 +38,18 @@ def create_app():
     from app.routes import api_blueprint
     app.register_blueprint(api_blueprint, url_prefix="/api")
 
+    # Uploads use the app's AWS settings (and S3_ENDPOINT_URL for a local stand-in)
+    from app.services.storage_service import storage_service
+    storage_service.configure(app.config)
+    # Documents and profile pictures go to the STORAGE_BACKEND selected in the app config
+    from app.services.blob_storage import blob_storage
+    blob_storage.configure(app.config)
+
+    # Optionally warm the shared models so the first grading request doesn't pay for loading
+    if app.config.get("WARM_MODELS_ON_STARTUP"):
+        from app.services.model_registry import model_registry
+        model_registry.warm_up(app.config.get("WARM_MODELS"))
+
     # Configure logging
     if not app.debug:
         # Log to a file with rotation
@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileRequired, FileAllowed
+from flask_wtf.file import FileRequired, FileAllowed, MultipleFileField
 from wtforms import StringField, SubmitField, PasswordField, FileField
-from wtforms.validators import InputRequired, Email, Length, EqualTo
+from wtforms.validators import InputRequired, Email, Length, EqualTo, Optional
 from .utils import password_complexity, validate_email_unique 
 
 class SignupForm(FlaskForm):
@@ -40,3 +40,11 @@ class ForgotPasswordForm(FlaskForm):
 class DocumentTestGraderForm(FlaskForm):
     document = FileField('file-upload', validators=[FileAllowed(['pdf'], 'PDF files only!'), InputRequired()])
     model = StringField('model-select', validators=[InputRequired(message="Feedback Model Selection is required!")])
+    # Optional exam identifier; reference answers are only reused between submissions of the same exam
+    exam_id = StringField('exam-id', validators=[Optional(), Length(max=100)])
+
+class BatchTestGraderForm(FlaskForm):
+    documents = MultipleFileField('documents', validators=[FileAllowed(['pdf'], 'PDF files only!')])
+    archive = FileField('archive', validators=[FileAllowed(['zip'], 'Zip archives only!')])
+    model = StringField('model-select', validators=[InputRequired(message="Feedback Model Selection is required!")])
+    exam_id = StringField('exam-id', validators=[Optional(), Length(max=100)])
@@ -1,16 +1,25 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from sqlalchemy.exc import IntegrityError
 from flask_bcrypt import Bcrypt
 from app import db
 from app.models import User, Document, UserProgress
-from app.forms import SignupForm, LoginForm, ForgotPasswordForm, DocumentTestGraderForm
+from app.forms import SignupForm, LoginForm, ForgotPasswordForm, DocumentTestGraderForm, BatchTestGraderForm
 from flask_login import login_user, logout_user, current_user, login_required
-from app.utils import upload_to_s3
+from app.utils import store_upload
 from werkzeug.utils import secure_filename
 from app.services.feedback_route import FeedbackService
+from app.services.batch_grading import BatchGradingService
+from app.services.rate_limiter import rate_limiter, UpstreamThrottled, PRIORITY_INTERACTIVE
+from app.services.job_queue import grading_jobs
+from app.services.llm_cache import llm_cache
+from app.services.result_cache import grading_results
+from app.services.reference_index import reference_index
+from app.services.ocr_cache import ocr_cache
+from app.services.data_extraction import page_source_stats
+from app.services.embedding_service import embedding_service
+from app.services.blob_storage import blob_storage, BlobNotFound
 import os, json, io
 import datetime
-from app.services.feedback_route import FeedbackService
 
 bcrypt = Bcrypt()
 api_blueprint = Blueprint('api', __name__)
@@ -34,7 +43,6 @@ def signup():
     email = form.email.data
     password = form.password.data
     profile_picture = request.files.get("profile_picture")
-    folder = "profilepictures"  
 
     current_app.logger.info(f"Creating user: {email}")
     hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
@@ -52,7 +60,7 @@ def signup():
     user_id = new_user.user_id
     if profile_picture:
         try:
-            file_url = upload_to_s3(profile_picture, user_id, folder, current_app)
+            file_url = store_upload(profile_picture, background=current_app.config.get("S3_BACKGROUND_UPLOADS"))
             new_user.profile_picture = file_url
             db.session.commit()
             current_app.logger.info(f"Profile picture uploaded for user {email}")
@@ -151,6 +159,7 @@ def document_pipeline():
         document = form.document.data
         document_name = document.filename
         model_selected = form.model.data
+        exam_id = form.exam_id.data or None
         print(f"DEBUG: Received document: {document_name} with model: {model_selected}")
     except Exception as e:
         print(f"ERROR: Error extracting form data: {e}")
@@ -158,29 +167,55 @@ def document_pipeline():
 
     # Read file bytes
     try:
-        file_bytes = io.BytesIO(document.read())
-        print(f"DEBUG: File bytes successfully read for document: {document_name}")
+        raw_bytes = document.read()
+        file_bytes = io.BytesIO(raw_bytes)
+        digest = grading_results.digest(raw_bytes)
+        print(f"DEBUG: File bytes successfully read for document: {document_name} (sha256 {digest})")
     except Exception as e:
         print(f"ERROR: Error reading file bytes for document: {document_name}. Error: {e}")
         return jsonify({"error": str(e)}), 500
 
-    # S3 folder name
-    folder = "documents"
+    # Same PDF graded with the same model before (or being graded right now): reuse that result/job
+    if current_app.config.get("RESULT_CACHE_ENABLED"):
+        cached = grading_results.get(digest, model_selected)
+        if cached is not None:
+            print(f"DEBUG: Returning cached grading result for document: {document_name}")
+            return jsonify({"status": "completed", "cached": True, "digest": digest, "result": cached}), 200
 
-    # Upload the document to S3
+    # Store the document (deduplicated by content, so re-uploads of the same PDF are not written again)
     try:
         document.seek(0)  # Reset the file pointer
-        file_url = upload_to_s3(document, 1, folder, current_app)  # Replace `1` with a generic user ID or logic
-        print(f"DEBUG: Document successfully uploaded to S3: {file_url}")
+        # Queued off the request path for S3 when S3_BACKGROUND_UPLOADS is on, so grading starts right away
+        file_url = store_upload(document, background=current_app.config.get("S3_BACKGROUND_UPLOADS"))
+        print(f"DEBUG: Document stored: {file_url}")
     except Exception as e:
-        print(f"ERROR: Error uploading document to S3: {document_name}. Error: {e}")
+        print(f"ERROR: Error storing document: {document_name}. Error: {e}")
         return jsonify({"error": str(e)}), 500
     
+    # Grading takes tens of seconds, so it runs as a background job; the client polls /test-grader/<job_id>
     feedback_service = FeedbackService()
-    try:
-        user_feedback_result_dict = feedback_service.feedback_route(file_bytes, model_selected)
-    except Exception as e:
-        print(f"ERROR: Feedback service failed. Error: {e}")
+    if current_app.config.get("RESULT_CACHE_ENABLED"):
+        def grade_and_store(file_bytes, model_selected, progress=None):
+            result = None
+            try:
+                result = feedback_service.feedback_route(file_bytes, model_selected, progress=progress, exam_id=exam_id)
+                return result
+            finally:
+                grading_results.finish(digest, model_selected, result)
+
+        cached, job_id = grading_results.start_or_join(
+            digest, model_selected,
+            start=lambda: grading_jobs.submit(grade_and_store, file_bytes, model_selected),
+            is_running=lambda job_id: (grading_jobs.get(job_id) or {}).get("status") in ("queued", "running"))
+        if cached is not None:
+            return jsonify({"status": "completed", "cached": True, "digest": digest, "result": cached}), 200
+    else:
+        job_id = grading_jobs.submit(feedback_service.feedback_route, file_bytes, model_selected, exam_id=exam_id)
+    print(f"DEBUG: Queued grading job {job_id} for document: {document_name}")
+    return jsonify({"job_id": job_id,
+                    "digest": digest,
+                    "status_url": f"/api/test-grader/{job_id}",
+                    "events_url": f"/api/test-grader/{job_id}/events"}), 202
 
     # Process feedback service
     # try:
@@ -250,6 +285,137 @@ def document_pipeline():
     # print("DEBUG: Document pipeline completed successfully.")
     # return jsonify(user_feedback_result_dict), 200
 
+@api_blueprint.route('/test-grader/batch', methods=["POST"])
+def batch_pipeline():
+    """
+    Grades many submissions of the same exam in one background job. Accepts several PDFs in
+    `documents` and/or a zip of PDFs in `archive`; progress (one "student" event per finished
+    submission, then "metrics") streams from /test-grader/<job_id>/events like a single upload.
+    """
+    form = BatchTestGraderForm()
+    if not form.validate_on_submit():
+        print(f"DEBUG: Batch form validation failed: {form.errors}")
+        return jsonify({"errors": form.errors}), 400
+
+    try:
+        submissions = BatchGradingService.read_submissions(request.files.getlist("documents"),
+                                                           request.files.get("archive"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    batch_service = BatchGradingService(use_result_cache=current_app.config.get("RESULT_CACHE_ENABLED"))
+    job_id = grading_jobs.submit(batch_service.grade_batch, submissions, form.model.data,
+                                 exam_id=form.exam_id.data or None)
+    print(f"DEBUG: Queued batch grading job {job_id} for {len(submissions)} documents")
+    return jsonify({"job_id": job_id,
+                    "submissions": len(submissions),
+                    "status_url": f"/api/test-grader/{job_id}",
+                    "events_url": f"/api/test-grader/{job_id}/events"}), 202
+
+@api_blueprint.route('/test-grader/<job_id>', methods=["GET"])
+def grading_job_status(job_id):
+    job = grading_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return jsonify(job), 200
+
+@api_blueprint.route('/test-grader/cache/<digest>', methods=["DELETE"])
+def invalidate_grading_result(digest):
+    # ?model=<choice> drops a single model's result, otherwise every result for the document goes
+    removed = grading_results.invalidate(digest, request.args.get("model"))
+    return jsonify({"digest": digest, "removed": removed}), 200
+
+@api_blueprint.route('/test-grader/<job_id>/events', methods=["GET"])
+def grading_job_events(job_id):
+    """
+    Server-Sent Events stream of a grading job: one event per finished stage
+    (per-page ocr / labeling, grammar_fix, model_answers, similarity, feedback, topics)
+    with elapsed seconds and the partial results, ending with "completed" or "failed".
+    """
+    if grading_jobs.get(job_id) is None:
+        return jsonify({"error": "Unknown job id"}), 404
+
+    # EventSource reconnects send the last id they saw
+    last_event_id = request.headers.get("Last-Event-ID")
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    def stream():
+        for event in grading_jobs.events(job_id, start=start):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            payload = json.dumps({"stage": event["stage"], "elapsed": event["elapsed"], **event["data"]}, default=str)
+            yield f"id: {event['id']}\nevent: {event['stage']}\ndata: {payload}\n\n"
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_blueprint.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "llm": llm_cache.stats(),
+        "ocr": ocr_cache.stats(),
+        "page_sources": page_source_stats(),
+        "embeddings": embedding_service.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "results": grading_results.stats(),
+        "reference_index": reference_index.stats(),
+        "blobs": blob_storage.summary(),
+    }), 200
+
+def parse_range(header, size):
+    """
+    Parses a single-range "bytes=start-end" / "bytes=start-" / "bytes=-suffix" header into an
+    inclusive (start, end) pair. Returns None for no/unsupported ranges and raises ValueError when unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError(header)
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        raise ValueError(header)
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+# Serves stored documents and profile pictures from either backend, with HTTP range support
+@api_blueprint.route("/blobs/<digest>", methods=["GET"])
+def get_blob(digest):
+    try:
+        info = blob_storage.stat(digest)
+    except BlobNotFound:
+        return jsonify({"error": "Blob not found"}), 404
+
+    size = info["size"]
+    headers = {"Accept-Ranges": "bytes", "ETag": f'"{digest}"', "Cache-Control": "private, max-age=31536000, immutable"}
+    if info.get("filename"):
+        headers["Content-Disposition"] = f'inline; filename="{secure_filename(info["filename"])}"'
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status=304, headers=headers)
+
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if byte_range is None:
+        status, start, end = 200, 0, None
+        headers["Content-Length"] = str(size)
+    else:
+        status, (start, end) = 206, byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+    chunks = blob_storage.read(digest, start, end) if size else iter(())
+    return Response(stream_with_context(chunks), status=status, mimetype=info["content_type"], headers=headers)
+
 @api_blueprint.route("/documents", methods=["GET"])
 @login_required
 def get_documents():
@@ -324,13 +490,12 @@ def user_profile():
 @login_required
 def update_profile_picture():
     profile_picture = request.files.get("profile_picture")
-    folder = "profilepictures"
 
     if not profile_picture:
         return jsonify({"error": "Profile picture is required"}), 400
 
     try:
-        file_url = upload_to_s3(profile_picture, current_user.id, folder, current_app)
+        file_url = store_upload(profile_picture)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -372,13 +537,22 @@ def generate_questions():
         return jsonify({"error": "Topic is required"}), 400
 
     print(f"Generating questions for topic: {topic}")
-    feedback_service = FeedbackService()
+    feedback_service = FeedbackService(priority=PRIORITY_INTERACTIVE)
 
     q_prompt = f"Generate 3 multiple choice questions based on the topic {topic} without any introduction or commentary.\
 #         Only provide an array of 3 questions with their respective answer choices in the following JSON format: \
 #         [{{'question': '...', 'choices': {{'A': '...', 'B': '...', 'C': '...', 'D': '...'}}, 'answer': '...'}}, {{'question': '...', 'choices': {{'A': '...', 'B': '...', 'C': '...', 'D': '...'}}, 'answer': '...'}}]"
-    questions_response = feedback_service.response_4o(q_prompt, [], 350)
-    
+    try:
+        questions_response = feedback_service.response_4o(q_prompt, [], 350)
+    except UpstreamThrottled as e:
+        print(f"ERROR: Question generation throttled: {e}")
+        return jsonify({"error": "The question generator is busy, please try again shortly"}), 429
+
+    questions_response = [q for q in questions_response
+                          if isinstance(q, dict) and {'question', 'choices', 'answer'} <= q.keys()]
+    if not questions_response:
+        return jsonify({"error": "Failed to generate questions"}), 502
+
     questions = [q['question'] for q in questions_response]
     answer_choices = [q['choices'] for q in questions_response]
     answers = [q['answer'] for q in questions_response]
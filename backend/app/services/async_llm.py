@@ -0,0 +1,112 @@
+import os
+import asyncio
+import threading
+import concurrent.futures
+import aiohttp
+import httpx
+
+from openai import AsyncOpenAI
+from azure.ai.inference.aio import ChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from app.services.llm_clients import GITHUB_MODELS_ENDPOINT
+from app.services.rate_limiter import rate_limiter, PRIORITY_BULK
+from config import Config
+
+
+class AsyncLLMRunner:
+    """Background asyncio loop for the LLM fan-out, with async provider clients kept per endpoint."""
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or Config.LLM_ASYNC_CONCURRENCY
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._sessions = []
+        self._limits = {}
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name="llm-async-loop", daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        # Starts the coroutine on the loop and returns a concurrent.futures.Future for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Not the builtin TimeoutError before Python 3.11
+            future.cancel()
+            raise
+
+    def run_all(self, coros, timeout=None):
+        # Runs the coroutines concurrently; failures come back as exception objects in their slot
+        async def gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.run(gather(), timeout)
+
+    # The helpers below must be called from coroutines running on self.loop
+
+    def openai(self, base_url=GITHUB_MODELS_ENDPOINT):
+        key = ("openai", base_url)
+        if key not in self._clients:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
+                timeout=httpx.Timeout(Config.LLM_READ_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+            )
+            self._clients[key] = AsyncOpenAI(base_url=base_url, api_key=os.environ["GITHUB_TOKEN"],
+                                              http_client=http_client, timeout=Config.LLM_READ_TIMEOUT)
+        return self._clients[key]
+
+    def azure(self, endpoint=GITHUB_MODELS_ENDPOINT):
+        key = ("azure", endpoint)
+        if key not in self._clients:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+            self._sessions.append(session)
+            transport = AioHttpTransport(session=session, session_owner=False,
+                                         connection_timeout=Config.LLM_CONNECT_TIMEOUT,
+                                         read_timeout=Config.LLM_READ_TIMEOUT)
+            self._clients[key] = ChatCompletionsClient(endpoint=endpoint,
+                                                       credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]),
+                                                       transport=transport)
+        return self._clients[key]
+
+    def limit(self, model):
+        if model not in self._limits:
+            self._limits[model] = asyncio.Semaphore(self.concurrency)
+        return self._limits[model]
+
+    async def call(self, model, request, timeout=None, tokens=0, priority=PRIORITY_BULK):
+        # One provider request: admitted by the shared rate limiter, then run under the model's
+        # semaphore and bounded by LLM_READ_TIMEOUT
+        async def send():
+            async with self.limit(model):
+                return await asyncio.wait_for(request(), timeout or Config.LLM_READ_TIMEOUT)
+        return await rate_limiter.call_async(model, send, tokens, priority)
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        async def close_clients():
+            for client in self._clients.values():
+                await client.close()
+            for session in self._sessions:
+                await session.close()
+            self._clients.clear()
+            self._sessions.clear()
+        self.run(close_clients(), timeout=10)
+
+
+async_llm = AsyncLLMRunner()
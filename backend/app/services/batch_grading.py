@@ -0,0 +1,203 @@
+import io
+import os
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from app.services.embedding_service import embedding_service
+from app.services.feedback_route import FeedbackService, CONSENSUS_MODELS, QUESTION_FIX_PROMPT, ANSWER_FIX_PROMPT
+from app.services.result_cache import grading_results
+from config import Config
+
+
+class BatchGradingService:
+    """Grades a whole class's submissions of one exam, asking the LLMs once per unique question."""
+    def __init__(self, feedback_service=None, use_result_cache=None):
+        self.feedback_service = feedback_service or FeedbackService()
+        # Routes pass the app's RESULT_CACHE_ENABLED, since the job thread has no app context
+        self.use_result_cache = Config.RESULT_CACHE_ENABLED if use_result_cache is None else use_result_cache
+
+    @staticmethod
+    def read_limited(stream, name):
+        # Reads at most BATCH_MAX_FILE_BYTES + 1 bytes, so an oversized (or lying) file is rejected without being buffered
+        data = stream.read(Config.BATCH_MAX_FILE_BYTES + 1)
+        if len(data) > Config.BATCH_MAX_FILE_BYTES:
+            raise ValueError(f"{name} is larger than {Config.BATCH_MAX_FILE_BYTES // 2**20} MB")
+        return data
+
+    @staticmethod
+    def read_submissions(files=(), archive=None):
+        """(filename, pdf bytes) from uploaded PDFs and/or a zip of PDFs; ValueError if empty or over the limits."""
+        submissions = []
+        total_bytes = 0
+
+        def add(name, data):
+            nonlocal total_bytes
+            total_bytes += len(data)
+            if total_bytes > Config.BATCH_MAX_TOTAL_BYTES:
+                raise ValueError(f"Documents exceed {Config.BATCH_MAX_TOTAL_BYTES // 2**20} MB in total")
+            submissions.append((name, data))
+
+        for f in files:
+            if f and f.filename:
+                add(f.filename, BatchGradingService.read_limited(f.stream, f.filename))
+        if archive is not None and archive.filename:
+            try:
+                with zipfile.ZipFile(archive.stream) as bundle:
+                    for info in bundle.infolist():
+                        name = info.filename
+                        if info.is_dir() or name.startswith("__MACOSX/") or not name.lower().endswith(".pdf"):
+                            continue
+                        if len(submissions) >= Config.BATCH_MAX_FILES:
+                            break
+                        # Check the declared size before decompressing anything; read_limited covers archives that lie
+                        if info.file_size > Config.BATCH_MAX_FILE_BYTES:
+                            raise ValueError(f"{os.path.basename(name)} is larger than {Config.BATCH_MAX_FILE_BYTES // 2**20} MB")
+                        with bundle.open(info) as member:
+                            add(os.path.basename(name), BatchGradingService.read_limited(member, os.path.basename(name)))
+            except zipfile.BadZipFile:
+                raise ValueError("Archive is not a valid zip file")
+        if not submissions:
+            raise ValueError("No PDF documents found in the upload")
+        if len(submissions) > Config.BATCH_MAX_FILES:
+            raise ValueError(f"At most {Config.BATCH_MAX_FILES} documents can be graded in one batch")
+        return submissions
+
+    def extract_all(self, submissions, pending, progress=None):
+        # {submission index: (questions, student_answers, page_sources)} plus {submission index: error}
+        exams, errors = {}, {}
+        workers = max(1, min(Config.BATCH_EXTRACTION_WORKERS, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-extract") as executor:
+            futures = {executor.submit(self.feedback_service.extract_exam, io.BytesIO(submissions[i][1])): i
+                       for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    exams[i] = future.result()
+                except Exception as e:
+                    print(f"extraction failed for {submissions[i][0]}: {e}")
+                    errors[i] = str(e)
+                    continue
+                self.feedback_service.report_progress(progress, "extracted", index=i, filename=submissions[i][0],
+                                                      questions=len(exams[i][0]), page_sources=exams[i][2])
+        return exams, errors
+
+    def grade_batch(self, submissions, model_choice, progress=None, exam_id=None):
+        fs = self.feedback_service
+        start = time.perf_counter()
+        timings = {}
+        digests = [grading_results.digest(data) for _, data in submissions]
+        students = [None] * len(submissions)
+
+        def finish_student(i, result=None, error=None, cached=False):
+            students[i] = {"index": i, "filename": submissions[i][0], "digest": digests[i],
+                           "cached": cached, "result": result, "error": error}
+            fs.report_progress(progress, "student", **students[i])
+
+        pending = []
+        for i, digest in enumerate(digests):
+            cached = grading_results.get(digest, model_choice) if self.use_result_cache else None
+            if cached is not None:
+                finish_student(i, cached, cached=True)
+            else:
+                pending.append(i)
+
+        phase = time.perf_counter()
+        exams, errors = self.extract_all(submissions, pending, progress)
+        for i, error in errors.items():
+            finish_student(i, error=error)
+        timings["extraction"] = round(time.perf_counter() - phase, 3)
+
+        # Every distinct question across the class, by normalized text, in first-seen order
+        unique_questions, unique_keys, question_map = [], {}, {}
+        for i, (questions, _, _) in exams.items():
+            question_map[i] = []
+            for question in questions:
+                key = embedding_service.normalize(question)
+                if key not in unique_keys:
+                    unique_keys[key] = len(unique_questions)
+                    unique_questions.append(question)
+                question_map[i].append(unique_keys[key])
+
+        phase = time.perf_counter()
+        graded = sorted(exams)
+        flat_answers, answer_offsets = [], {}
+        for i in graded:
+            answers = fs.align_answers(exams[i][1], len(exams[i][0]))
+            answer_offsets[i] = (len(flat_answers), len(answers))
+            flat_answers.extend(answers)
+        fixed_questions = fs.chunked_responses("gpt-4o", QUESTION_FIX_PROMPT, unique_questions, fs.rewrite_tokens, fallback=str)
+        fixed_answers = fs.chunked_responses("gpt-4o", ANSWER_FIX_PROMPT, flat_answers, fs.rewrite_tokens, fallback=str)
+        fs.report_progress(progress, "grammar_fix", unique_questions=len(unique_questions), answers=len(flat_answers))
+        timings["grammar_fix"] = round(time.perf_counter() - phase, 3)
+
+        # Reference answers and topics once per unique question
+        phase = time.perf_counter()
+        scope = fs.reference_scope(fixed_questions, exam_id)
+        answer_sets = fs.reference_answer_sets(fixed_questions, scope=scope)
+        consensus = fs.grade_answers(fixed_questions, [""] * len(fixed_questions), answer_sets)
+        fs.remember_reference_answers(fixed_questions, consensus["model_answers"], consensus["choices"],
+                                      consensus["pair_similarities"], scope=scope)
+        reference_answers = consensus["model_answers"]
+        fs.report_progress(progress, "model_answers", unique_questions=len(fixed_questions))
+        topics = fs.get_topics(fixed_questions)
+        fs.report_progress(progress, "topics", unique_questions=len(fixed_questions))
+        timings["reference_answers"] = round(time.perf_counter() - phase, 3)
+
+        def grade_student(i):
+            indices = question_map[i]
+            questions = [fixed_questions[u] for u in indices]
+            offset, count = answer_offsets[i]
+            student_answers = fixed_answers[offset:offset + count]
+            student_sets = {model_name: None for model_name in CONSENSUS_MODELS}
+            student_sets['reference'] = [reference_answers[u] for u in indices]
+            scores = fs.grade_answers(questions, student_answers, student_sets)
+            grading = fs.split_by_grade(questions, student_answers, scores)
+            feedback = fs.generate_feedback(grading["wrong_questions"], grading["wrong_student_answers"],
+                                            grading["correct_questions"], grading["correct_student_answers"],
+                                            grading["model_answers"], model_choice)
+            result = {
+                "feedback": feedback,
+                "wrong_questions": grading["wrong_questions"],
+                "wrong_student_answers": grading["wrong_student_answers"],
+                "correct_questions": grading["correct_questions"],
+                "correct_student_answers": grading["correct_student_answers"],
+                "wrong_topics": [topics[indices[j]] for j in scores["wrong_indices"]],
+                "correct_topics": [topics[indices[j]] for j in scores["correct_indices"]],
+            }
+            if self.use_result_cache:
+                grading_results.put(digests[i], model_choice, result)
+            return result
+
+        phase = time.perf_counter()
+        if graded:
+            workers = max(1, min(Config.BATCH_FEEDBACK_WORKERS, len(graded)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-feedback") as executor:
+                futures = {executor.submit(grade_student, i): i for i in graded}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        finish_student(i, future.result())
+                    except Exception as e:
+                        print(f"grading failed for {submissions[i][0]}: {e}")
+                        finish_student(i, error=str(e))
+        timings["grading"] = round(time.perf_counter() - phase, 3)
+
+        elapsed = time.perf_counter() - start
+        total_questions = sum(len(indices) for indices in question_map.values())
+        metrics = {
+            "students": len(submissions),
+            "graded": sum(1 for s in students if s["error"] is None),
+            "cached": sum(1 for s in students if s["cached"]),
+            "failed": sum(1 for s in students if s["error"] is not None),
+            "total_questions": total_questions,
+            "unique_questions": len(unique_questions),
+            "deduplicated_questions": total_questions - len(unique_questions),
+            "elapsed": round(elapsed, 3),
+            "students_per_minute": round(len(submissions) / elapsed * 60, 2) if elapsed else 0.0,
+            "stage_seconds": timings,
+        }
+        print(f"batch graded {metrics['students']} submissions in {metrics['elapsed']}s "
+              f"({metrics['unique_questions']} unique of {total_questions} questions)")
+        fs.report_progress(progress, "metrics", **metrics)
+        return {"students": students, "metrics": metrics}
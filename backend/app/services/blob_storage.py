@@ -0,0 +1,278 @@
+import io
+import os
+import re
+import json
+import hashlib
+import tempfile
+import threading
+
+from abc import ABC, abstractmethod
+from botocore.exceptions import ClientError
+from app.services.storage_service import Configurable, storage_service
+from config import Config
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobStore(ABC):
+    """Content-addressed storage: each blob is stored once under its sha256 digest."""
+    name = None
+
+    def put(self, stream, filename=None, content_type="application/octet-stream"):
+        hasher = hashlib.sha256()
+        # Spool to memory, rolling over to disk for large files, so the digest is known before storing
+        with tempfile.SpooledTemporaryFile(max_size=Config.BLOB_SPOOL_MAX_MEMORY) as spool:
+            size = 0
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            digest = hasher.hexdigest()
+            if self._exists(digest):
+                print(f"blob {digest} already stored, skipping write")
+                return digest, size, False
+            spool.seek(0)
+            self._store(digest, spool, size, {"content_type": content_type, "filename": filename})
+        return digest, size, True
+
+    @abstractmethod
+    def _exists(self, digest):
+        pass
+
+    @abstractmethod
+    def _store(self, digest, fileobj, size, metadata):
+        pass
+
+    @abstractmethod
+    def stat(self, digest):
+        pass
+
+    @abstractmethod
+    def read(self, digest, start=0, end=None):
+        pass
+
+    @abstractmethod
+    def delete(self, digest):
+        pass
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under BLOB_LOCAL_ROOT, with a .json metadata sidecar."""
+    name = "local"
+
+    def __init__(self, root=None):
+        self.root = root or Config.BLOB_LOCAL_ROOT
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def _store(self, digest, fileobj, size, metadata):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            with open(path + ".json", "w", encoding="utf-8") as meta:
+                json.dump(dict(metadata, size=size), meta)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def stat(self, digest):
+        path = self.path(digest)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise BlobNotFound(digest)
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as meta:
+                metadata = json.load(meta)
+        except (OSError, ValueError):
+            metadata = {}
+        return {"size": size,
+                "content_type": metadata.get("content_type") or "application/octet-stream",
+                "filename": metadata.get("filename")}
+
+    def read(self, digest, start=0, end=None):
+        try:
+            f = open(self.path(digest), "rb")
+        except OSError:
+            raise BlobNotFound(digest)
+
+        def chunks():
+            with f:
+                f.seek(start)
+                remaining = None if end is None else end - start + 1
+                while remaining is None or remaining > 0:
+                    chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+        return chunks()
+
+    def delete(self, digest):
+        for path in (self.path(digest), self.path(digest) + ".json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as S3 objects under BLOB_S3_PREFIX, uploaded through the storage service."""
+    name = "s3"
+
+    def __init__(self, storage=None, prefix=None):
+        self.storage = storage or storage_service
+        self.prefix = (prefix if prefix is not None else Config.BLOB_S3_PREFIX).strip("/")
+
+    def key(self, digest):
+        return f"{self.prefix}/{digest}" if self.prefix else digest
+
+    def _exists(self, digest):
+        return self.storage.head(self.key(digest)) is not None
+
+    def object_metadata(self, filename):
+        # S3 user metadata must be ASCII
+        return {"filename": filename.encode("ascii", "ignore").decode()} if filename else None
+
+    def _store(self, digest, fileobj, size, metadata):
+        self.storage.upload(fileobj, self.key(digest), metadata["content_type"],
+                            metadata=self.object_metadata(metadata.get("filename")))
+
+    def put_in_background(self, data, filename=None, content_type="application/octet-stream", on_error=None,
+                          on_done=None):
+        # Only hashing runs on the request path; the existence check and the upload (with retries) run
+        # on the storage service's upload threads. `on_done(stored)` gets False for an existing blob.
+        digest = hashlib.sha256(data).hexdigest()
+        self.storage.upload_in_background(data, self.key(digest), content_type, on_error=on_error, skip_existing=True,
+                                          metadata=self.object_metadata(filename), on_done=on_done)
+        return digest
+
+    def stat(self, digest):
+        head = self.storage.head(self.key(digest))
+        if head is None:
+            raise BlobNotFound(digest)
+        return {"size": head["ContentLength"],
+                "content_type": head.get("ContentType") or "application/octet-stream",
+                "filename": head.get("Metadata", {}).get("filename")}
+
+    def read(self, digest, start=0, end=None):
+        request = {"Bucket": self.storage.bucket, "Key": self.key(digest)}
+        if start or end is not None:
+            request["Range"] = f"bytes={start}-{'' if end is None else end}"
+        try:
+            response = self.storage.client().get_object(**request)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise BlobNotFound(digest)
+            raise
+        return response["Body"].iter_chunks(CHUNK_SIZE)
+
+    def delete(self, digest):
+        self.storage.client().delete_object(Bucket=self.storage.bucket, Key=self.key(digest))
+
+
+BACKENDS = {"local": LocalBlobStore, "s3": S3BlobStore}
+
+
+class BlobStorage(Configurable):
+    """The blob store selected by STORAGE_BACKEND."""
+    def __init__(self, settings=None):
+        self._settings = settings or {}
+        self._backend = None
+        self._lock = threading.Lock()
+        self.stats = {"stored": 0, "deduplicated": 0, "queued": 0, "bytes_stored": 0, "bytes_deduplicated": 0}
+
+    def configure(self, settings):
+        with self._lock:
+            self._settings = settings
+            self._backend = None
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                name = str(self.setting("STORAGE_BACKEND")).lower()
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown STORAGE_BACKEND '{name}', expected one of {sorted(BACKENDS)}")
+                if name == "local":
+                    self._backend = LocalBlobStore(self.setting("BLOB_LOCAL_ROOT"))
+                else:
+                    self._backend = S3BlobStore(prefix=self.setting("BLOB_S3_PREFIX"))
+                print(f"Blob storage backend: {name}")
+            return self._backend
+
+    def _count(self, stored, size):
+        with self._lock:
+            key = "stored" if stored else "deduplicated"
+            self.stats[key] += 1
+            self.stats["bytes_" + key] += size
+
+    def put(self, stream, filename=None, content_type="application/octet-stream"):
+        """Stores the stream and returns its digest."""
+        digest, size, stored = self.backend.put(stream, filename, content_type)
+        self._count(stored, size)
+        return digest
+
+    def put_bytes(self, data, filename=None, content_type="application/octet-stream", background=False, on_error=None):
+        """With `background=True` on S3 the digest is returned before the upload finishes."""
+        backend = self.backend
+        if background and isinstance(backend, S3BlobStore):
+            digest = backend.put_in_background(data, filename, content_type, on_error,
+                                               on_done=lambda stored: self._count(stored, len(data)))
+            with self._lock:
+                self.stats["queued"] += 1
+            return digest
+        return self.put(io.BytesIO(data), filename, content_type)
+
+    def stat(self, digest):
+        if not DIGEST_PATTERN.match(digest or ""):
+            raise BlobNotFound(digest)
+        return self.backend.stat(digest)
+
+    def read(self, digest, start=0, end=None):
+        if not DIGEST_PATTERN.match(digest or ""):
+            raise BlobNotFound(digest)
+        return self.backend.read(digest, start, end)
+
+    def delete(self, digest):
+        if DIGEST_PATTERN.match(digest or ""):
+            self.backend.delete(digest)
+
+    def url(self, digest):
+        # Absolute, since the frontend runs on another origin: the S3 object itself, or this API's
+        # /api/blobs route for local blobs
+        backend = self.backend
+        if isinstance(backend, S3BlobStore):
+            return backend.storage.object_url(backend.key(digest))
+        return f"{self.setting('BLOB_PUBLIC_BASE_URL').rstrip('/')}/api/blobs/{digest}"
+
+    def summary(self):
+        with self._lock:
+            backend = self._backend
+            summary = dict(self.stats, backend=backend.name if backend else None)
+        if isinstance(backend, S3BlobStore):
+            summary["uploads"] = backend.storage.summary()
+        return summary
+
+
+blob_storage = BlobStorage()
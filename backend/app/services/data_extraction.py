@@ -1,32 +1,47 @@
-import os
 import re
 import torch
 import numpy as np
 import fitz
 import cv2
 import pytesseract
+import multiprocessing
+import threading
+import queue
+import time
 
-from collections import defaultdict
-from transformers import AutoModelForTokenClassification, AutoTokenizer
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
 from openai import OpenAI
+from config import Config
+from app.services.model_registry import model_registry
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_pool import ocr_pool
 
 class DataExtraction:
     def __init__(self):
 
         self.question_answer_dict = defaultdict(list)
+        # page_number -> "text_layer" or "ocr", whichever path produced the page text
+        self.page_sources = {}
         
         self.label_list = ["O", "B-QUESTION", "I-QUESTION", "B-ANSWER", "I-ANSWER"]
         self.id_to_label_dict = dict(enumerate(self.label_list))
 
-        model_dir = os.path.join(os.path.dirname(__file__), "..", "inference_model")
+    # The tokenizer and weights are borrowed from the process-wide registry,
+    # so building a DataExtraction per request no longer reloads the model.
+    @property
+    def tokenizer(self):
+        return model_registry.get("ner")["tokenizer"]
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
-        self.model = AutoModelForTokenClassification.from_pretrained(model_dir)
+    @property
+    def model(self):
+        return model_registry.get("ner")["model"]
 
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
-        self.model.eval()
+    @property
+    def device(self):
+        return model_registry.get("ner")["device"]
 
     def cleanse_text(self, text):
 
@@ -41,53 +56,137 @@ class DataExtraction:
         _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
         return thresh
 
+    def render_page(self, page):
+        # Grayscale straight from MuPDF: one byte per pixel and no RGB -> BGR -> gray conversions later
+        return page.get_pixmap(dpi=Config.OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+
+    def binarize_pixmap(self, pixmap):
+        """Otsu-thresholds a grayscale pixmap in place, through a NumPy view of its samples."""
+        gray = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+        if not gray.flags.writeable:
+            gray = gray.copy()
+        cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=gray)
+        return gray
+
+    def ocr_cache_key(self, image):
+        # Hash of the rendered pixels plus everything that affects how they were OCRed.
+        # Pixmaps and arrays are hashed through a buffer view (`samples` would copy the whole page)
+        if isinstance(image, fitz.Pixmap):
+            image_bytes = image.samples_mv
+            settings = {"width": image.width, "height": image.height, "n": image.n, "alpha": image.alpha,
+                        "xres": image.xres, "yres": image.yres}
+        elif isinstance(image, np.ndarray):
+            image_bytes = np.ascontiguousarray(image).data
+            settings = {"shape": list(image.shape), "dtype": str(image.dtype)}
+        else:
+            image_bytes = image.tobytes()
+            settings = {"size": list(image.size), "mode": image.mode}
+        settings["preprocess"] = "otsu"
+        return ocr_cache.key(image_bytes, settings)
+
     def generate_ocr(self, image):
+        return self.generate_ocr_with_source(image)[0]
+
+    def generate_ocr_with_source(self, image):
+        """
+        OCR through the page cache. Returns (text, source) where source is
+        "ocr_cache" on a hit and "ocr" when tesseract actually ran.
+        """
+        if not Config.OCR_CACHE_ENABLED:
+            return self.run_ocr(image), "ocr"
+
+        key = self.ocr_cache_key(image)
+        cached_text = ocr_cache.get(key)
+        if cached_text is not None:
+            return cached_text, "ocr_cache"
+
+        start = time.perf_counter()
+        ocr_text = self.run_ocr(image)
+        ocr_cache.put(key, ocr_text, time.perf_counter() - start)
+        return ocr_text, "ocr"
+
+    def binarize(self, image):
+        if isinstance(image, fitz.Pixmap) and image.n == 1 and not image.alpha:
+            return self.binarize_pixmap(image)
+
         if isinstance(image, fitz.Pixmap): 
             image = Image.frombytes("RGB", [image.width, image.height], image.samples)
         cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        preprocessed_image = self.preprocess_with_cv2(cv_image)
-        pil_image = Image.fromarray(preprocessed_image)
+        return self.preprocess_with_cv2(cv_image)
 
-        # Perform OCR
-        ocr_text = pytesseract.image_to_string(pil_image).strip()
-        ocr_text = self.cleanse_text(ocr_text)
-        return ocr_text
+    def recognize(self, binarized_image):
+        # OCR_BACKEND "pool" hands the image to the persistent OCR workers,
+        # "pytesseract" runs a tesseract subprocess per page
+        if Config.OCR_BACKEND == "pool":
+            ocr_text = ocr_pool.submit(binarized_image).result()
+        else:
+            ocr_text = pytesseract.image_to_string(binarized_image)
+        return self.cleanse_text(ocr_text.strip())
+
+    def run_ocr(self, image):
+        return self.recognize(self.binarize(image))
 
     def predict_qa_labels_on_text(self, text: str):
+        return self.predict_qa_labels_on_pages([text])[0]
+
+    def predict_qa_labels_on_pages(self, texts):
+        """Sliding-window NER over several pages in one batch; returns the token results of each text."""
+        if not texts:
+            return []
+
         encoding = self.tokenizer(
-            text,
+            texts,
             return_offsets_mapping=True,
+            return_overflowing_tokens=True,
             return_tensors="pt",
-            truncation=False,
-            padding=False
+            truncation=True,
+            max_length=Config.NER_MAX_LENGTH,
+            stride=Config.NER_STRIDE,
+            padding=True
         )
-        input_ids = encoding["input_ids"].to(self.device)
-        attention_mask = encoding["attention_mask"].to(self.device)
-        offsets = encoding["offset_mapping"] 
+        input_ids = encoding["input_ids"]
+        attention_mask = encoding["attention_mask"]
+        offsets = encoding["offset_mapping"].numpy()
+        window_to_page = encoding["overflow_to_sample_mapping"].numpy()
 
+        batch_size = Config.NER_BATCH_SIZE
+        pred_batches = []
         with torch.no_grad():
-            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
-        logits = outputs.logits  
-
-        pred_ids = torch.argmax(logits, dim=-1).squeeze().cpu().numpy()
-
-        results = []
-        for i, label_id in enumerate(pred_ids):
-            label_str = self.id_to_label_dict[label_id]
-            start_char = offsets[0, i, 0].item()
-            end_char   = offsets[0, i, 1].item()
+            for start in range(0, input_ids.shape[0], batch_size):
+                outputs = self.model(
+                    input_ids=input_ids[start:start + batch_size].to(self.device),
+                    attention_mask=attention_mask[start:start + batch_size].to(self.device)
+                )
+                pred_batches.append(torch.argmax(outputs.logits, dim=-1).cpu())
+        pred_ids = torch.cat(pred_batches).numpy()
+        window_lengths = attention_mask.sum(dim=1).numpy()
 
-            if start_char == 0 and end_char == 0 and i == 0:
-                continue
+        # (start_char, end_char) -> (distance from window edge, label id), per page
+        best_predictions = [dict() for _ in texts]
+        for window, page in enumerate(window_to_page):
+            n_tokens = int(window_lengths[window])
+            for i in range(n_tokens):
+                start_char, end_char = (int(x) for x in offsets[window, i])
+                # special tokens and padding carry an empty offset span
+                if start_char == end_char:
+                    continue
+                edge_distance = min(i, n_tokens - 1 - i)
+                previous = best_predictions[page].get((start_char, end_char))
+                if previous is None or edge_distance > previous[0]:
+                    best_predictions[page][(start_char, end_char)] = (edge_distance, int(pred_ids[window, i]))
 
-            token_str = text[start_char:end_char]
-            results.append({
-                "token_str": token_str,
-                "start_char": start_char,
-                "end_char": end_char,
-                "label": label_str
-            })
-        return results
+        all_results = []
+        for text, predictions in zip(texts, best_predictions):
+            results = []
+            for (start_char, end_char), (_, label_id) in sorted(predictions.items()):
+                results.append({
+                    "token_str": text[start_char:end_char],
+                    "start_char": start_char,
+                    "end_char": end_char,
+                    "label": self.id_to_label_dict[label_id]
+                })
+            all_results.append(results)
+        return all_results
 
     def group_labeled_spans(self, results):
         grouped = []
@@ -188,21 +287,310 @@ class DataExtraction:
                         "answer": span["text"]
                     })
 
-    def data_extraction(self, pdf_file):
-        pdf_document = fitz.open(stream=pdf_file, filetype="pdf")  # Open from memory
-        for page_number in range(len(pdf_document)):
-            page = pdf_document[page_number]
-            image = page.get_pixmap()
-            ocr_text = self.generate_ocr(image)
+    def read_pdf_bytes(self, pdf_file):
+        # Worker processes need the raw bytes, not an open file handle
+        if isinstance(pdf_file, (bytes, bytearray)):
+            return bytes(pdf_file)
+        if isinstance(pdf_file, str):
+            with open(pdf_file, "rb") as f:
+                return f.read()
+        if hasattr(pdf_file, "getvalue"):
+            return pdf_file.getvalue()
+        pdf_file.seek(0)
+        return pdf_file.read()
+
+    def text_layer(self, page):
+        """The page's embedded text when it can stand in for OCR, else None."""
+        text = self.cleanse_text(page.get_text("text"))
+        if len(text) < Config.TEXT_LAYER_MIN_CHARS:
+            return None
+
+        page_area = abs(page.rect)
+        for image_info in page.get_image_info():
+            image_area = abs(fitz.Rect(image_info["bbox"]) & page.rect)
+            if page_area and image_area / page_area > Config.TEXT_LAYER_MAX_IMAGE_COVERAGE:
+                return None
+        return text
+
+    def text_layer_stats(self):
+        return source_stats(Counter(self.page_sources.values()))
+
+    def data_extraction(self, pdf_file, ocr_workers=None):
+        # Non-streaming entry point: run the whole pipeline and return every page's entries
+        for _ in self.stream_extraction(pdf_file, ocr_workers=ocr_workers):
+            pass
+        return self.question_answer_dict
+
+    def ocr_executor(self, page_count, workers):
+        """Returns (executor, in_processes) for the OCR stage."""
+        if Config.OCR_BACKEND != "pool" and workers > 1 and page_count > 1:
+            return page_ocr_pool.executor(), True
+        return ThreadPoolExecutor(max_workers=max(1, workers)), False
+
+    def stream_extraction(self, pdf_file, queue_size=None, ocr_workers=None, progress=None):
+        """Yields (page_number, qa_entries) in page order while later pages are still being OCRed."""
+        pdf_bytes = self.read_pdf_bytes(pdf_file)
+        queue_size = queue_size or Config.PIPELINE_QUEUE_SIZE
+        ocr_workers = ocr_workers or Config.OCR_WORKERS
+        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        page_count = len(pdf_document)
+        stop_event = threading.Event()
+
+        # OCR futures wait here in page order; the extra `ocr_workers` slots let that many pages be OCRed
+        # while the pages ahead of them are still waiting for the label stage
+        ocr_queue = queue.Queue(maxsize=queue_size + ocr_workers)
+        label_queue = queue.Queue(maxsize=max(queue_size, Config.NER_PAGE_BATCH))
+        group_queue = queue.Queue(maxsize=queue_size)
+        assembly_queue = queue.Queue(maxsize=queue_size)
+        # Picked on the first page that needs OCR, so text-layer-only exams never start OCR workers
+        ocr_executor, in_processes = None, False
+        ocr_futures = []
+
+        def render_stage():
+            nonlocal ocr_executor, in_processes
+            for page_number in range(page_count):
+                page = pdf_document[page_number]
+                text = self.text_layer(page)
+                if text is not None:
+                    yield page_number, (text, "text_layer")
+                    continue
+                if ocr_executor is None:
+                    ocr_executor, in_processes = self.ocr_executor(page_count, ocr_workers)
+                if in_processes:
+                    # Workers are shared across documents, so each gets just its page as a one-page PDF
+                    future = page_ocr_pool.submit(page_pdf_bytes(pdf_document, page_number))
+                else:
+                    future = ocr_executor.submit(self.generate_ocr_with_source, self.render_page(page))
+                ocr_futures.append(future)
+                yield page_number, future
+
+        def ocr_stage(page_number, pending):
+            if isinstance(pending, tuple):
+                text, source = pending
+            elif in_processes:
+                # The cache lookup ran in a worker process; count it here so /cache-stats sees it
+                text, source, cache_counters = pending.result()
+                ocr_cache.merge(cache_counters)
+            else:
+                text, source = pending.result()
+            self.page_sources[page_number] = source
+            _count_page_source(source)
             print(f"======================= FINISHED OCR STAGE SUCCESSFULLY FOR PAGE {page_number} ==============================")
-            token_results = self.predict_qa_labels_on_text(ocr_text)
-            print(f"======================= FINISHED LABEL PREDICTION STAGE SUCCESSFULLY FOR PAGE {page_number} ==============================")
+            if progress is not None:
+                progress("ocr", page=page_number, source=source, text=text)
+            return text
+
+        def label_stage(pages):
+            page_token_results = self.predict_qa_labels_on_pages([text for _, text in pages])
+            print(f"======================= FINISHED LABEL PREDICTION STAGE SUCCESSFULLY FOR PAGES {[page_number for page_number, _ in pages]} ==============================")
+            return page_token_results
+
+        def group_stage(page_number, token_results):
             grouped_results = self.group_labeled_spans(token_results)
             print(f"======================= FINISHED LABEL GROUPING STAGE SUCCESSFULLY FOR PAGE {page_number} ==============================")
-            self.populate_question_answer_dict(grouped_results, page_number=page_number)
-            print(f"======================= FINISHED QUESTION ANSWER STAGE SUCCESSFULLY FOR PAGE {page_number} ==============================")
+            return grouped_results
 
-        return self.question_answer_dict
+        threads = [
+            threading.Thread(target=_source_worker, args=(render_stage, ocr_queue, stop_event), daemon=True),
+            threading.Thread(target=_stage_worker, args=(ocr_stage, ocr_queue, label_queue, stop_event), daemon=True),
+            threading.Thread(target=_batch_stage_worker, args=(label_stage, label_queue, group_queue, stop_event,
+                                                               Config.NER_PAGE_BATCH), daemon=True),
+            threading.Thread(target=_stage_worker, args=(group_stage, group_queue, assembly_queue, stop_event), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = assembly_queue.get()
+                if item is _PIPELINE_END:
+                    break
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                page_number, grouped_results = item
+                self.populate_question_answer_dict(grouped_results, page_number=page_number)
+                print(f"======================= FINISHED QUESTION ANSWER STAGE SUCCESSFULLY FOR PAGE {page_number} ==============================")
+                if progress is not None:
+                    progress("labeling", page=page_number, question_answers=self.question_answer_dict[page_number])
+                yield page_number, self.question_answer_dict[page_number]
+        finally:
+            # Consumer finished or gave up early: unblock and stop every stage
+            stop_event.set()
+            for q in (ocr_queue, label_queue, group_queue, assembly_queue):
+                _drain(q)
+            for future in ocr_futures:
+                future.cancel()
+            if ocr_executor is not None and not in_processes:
+                ocr_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def source_stats(counts):
+    # How many pages came from the text layer, the OCR cache or a real OCR run
+    pages = sum(counts.values())
+    return {
+        "pages": pages,
+        "text_layer": counts["text_layer"],
+        "ocr_cache": counts["ocr_cache"],
+        "ocr": counts["ocr"],
+        "hit_rate": counts["text_layer"] / pages if pages else 0.0
+    }
+
+# Page sources of every document extracted by this process, for /cache-stats
+_page_source_counts = Counter()
+_page_source_lock = threading.Lock()
+
+def _count_page_source(source):
+    with _page_source_lock:
+        _page_source_counts[source] += 1
+
+def page_source_stats():
+    with _page_source_lock:
+        return source_stats(Counter(_page_source_counts))
+
+
+# Streaming pipeline plumbing: stages pass (page_number, payload) tuples downstream,
+# followed by _PIPELINE_END. A failure is forwarded as _StageFailure so the consumer re-raises it.
+_PIPELINE_END = object()
+
+class _StageFailure:
+    def __init__(self, error):
+        self.error = error
+
+def _put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _drain(q):
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+
+def _source_worker(produce, out_queue, stop_event):
+    try:
+        for item in produce():
+            if not _put(out_queue, item, stop_event):
+                return
+        _put(out_queue, _PIPELINE_END, stop_event)
+    except Exception as e:
+        _put(out_queue, _StageFailure(e), stop_event)
+
+def _stage_worker(fn, in_queue, out_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _PIPELINE_END or isinstance(item, _StageFailure):
+            _put(out_queue, item, stop_event)
+            return
+        page_number, payload = item
+        try:
+            result = fn(page_number, payload)
+        except Exception as e:
+            _put(out_queue, _StageFailure(e), stop_event)
+            return
+        if not _put(out_queue, (page_number, result), stop_event):
+            return
+
+def _batch_stage_worker(fn, in_queue, out_queue, stop_event, max_batch):
+    # Like _stage_worker, but fn gets every item already waiting (up to max_batch) and returns one result per item
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        batch, finished = [], None
+        while True:
+            if item is _PIPELINE_END or isinstance(item, _StageFailure):
+                finished = item
+                break
+            batch.append(item)
+            if len(batch) >= max_batch:
+                break
+            try:
+                item = in_queue.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                results = fn(batch)
+            except Exception as e:
+                _put(out_queue, _StageFailure(e), stop_event)
+                return
+            for (page_number, _), result in zip(batch, results):
+                if not _put(out_queue, (page_number, result), stop_event):
+                    return
+        if finished is not None:
+            _put(out_queue, finished, stop_event)
+            return
+
+
+def page_pdf_bytes(pdf_document, page_number):
+    page_document = fitz.open()
+    page_document.insert_pdf(pdf_document, from_page=page_number, to_page=page_number)
+    return page_document.tobytes()
+
+
+class PageOCRPool:
+    """OCR_WORKERS processes that render and OCR single pages, shared by every document in the process."""
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = self.workers or Config.OCR_WORKERS
+                mp_context = multiprocessing.get_context(Config.OCR_START_METHOD) if Config.OCR_START_METHOD else None
+                self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                                                     initializer=_init_ocr_worker)
+                print(f"started page OCR pool ({workers} workers)")
+            return self._executor
+
+    def submit(self, page_pdf):
+        executor = self.executor()
+        try:
+            return executor.submit(_ocr_page, page_pdf)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); start a fresh pool rather than failing every later document
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            return self.executor().submit(_ocr_page, page_pdf)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+# Page OCR workers render + OCR the one-page PDFs they are handed (pages with a usable
+# text layer never get here). The NER model is never touched here, so workers stay light.
+_worker_extractor = None
+
+def _init_ocr_worker():
+    global _worker_extractor
+    _worker_extractor = DataExtraction()
+
+def _ocr_page(page_pdf):
+    # Returns (text, source, cache counter changes) for the parent to merge into its own counters
+    before = ocr_cache.counters()
+    page_document = fitz.open(stream=page_pdf, filetype="pdf")
+    text, source = _worker_extractor.generate_ocr_with_source(_worker_extractor.render_page(page_document[0]))
+    after = ocr_cache.counters()
+    return text, source, {name: after[name] - before[name] for name in after}
+
+
+page_ocr_pool = PageOCRPool()
 
 # if __name__ == "__main__":
 #     pdf_file = "/Users/vasumittal/NOSUHackathon/backend/app/services/synthetic_doc_1.pdf"
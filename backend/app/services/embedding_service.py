@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from config import Config
+from app.services.model_registry import model_registry
+
+
+class EmbeddingService:
+    """Keeps the sentence embedding model resident and caches normalized embeddings."""
+    def __init__(self, model_name="sentence_transformer", cache_size=None):
+        self.model_name = model_name
+        self.cache_size = cache_size if cache_size is not None else Config.EMBEDDING_CACHE_SIZE
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        if text is None:
+            return ""
+        return " ".join(str(text).split()).lower()
+
+    def _cache_get(self, key):
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return vector
+
+    def _cache_put(self, key, vector):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def encode_many(self, texts):
+        keys = [self.normalize(text) for text in texts]
+        vectors = [self._cache_get(key) for key in keys]
+
+        missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            model = model_registry.get(self.model_name)
+            encoded = model.encode(missing, convert_to_numpy=True, normalize_embeddings=True)
+            fresh = dict(zip(missing, encoded))
+            for key, vector in fresh.items():
+                self._cache_put(key, vector)
+            vectors = [vector if vector is not None else fresh[key] for key, vector in zip(keys, vectors)]
+
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def encode(self, text):
+        return self.encode_many([text])[0]
+
+    def similarity(self, text_1, text_2):
+        embeddings = self.encode_many([text_1, text_2])
+        return float(np.dot(embeddings[0], embeddings[1]))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+embedding_service = EmbeddingService()
@@ -1,197 +1,595 @@
 
-import os, ast
-from openai import OpenAI
-from azure.ai.inference import ChatCompletionsClient
+import ast, json, time, asyncio, hashlib
+import numpy as np
 from azure.ai.inference.models import SystemMessage
 from azure.ai.inference.models import UserMessage
-from azure.core.credentials import AzureKeyCredential
-from sentence_transformers import SentenceTransformer, util
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from app.services.data_extraction import DataExtraction
+from app.services.embedding_service import embedding_service
+from app.services.llm_cache import llm_cache
+from app.services.reference_index import reference_index
+from app.services.stage_graph import StageGraph
+from app.services.llm_clients import llm_clients, GITHUB_MODELS_ENDPOINT, OPENAI_ENDPOINT
+from app.services.async_llm import async_llm
+from app.services.prompt_planner import prompt_planner
+from app.services.rate_limiter import rate_limiter, estimate_tokens, UpstreamThrottled, PRIORITY_BULK
+from config import Config
+
+CONSENSUS_COMBINE = -1
+CONSENSUS_4O = 0
+CONSENSUS_LLAMA = 1
+CONSENSUS_REFERENCE = 2
+CONSENSUS_MODELS = ('gpt-4o', 'llama', 'mistral')
+
+QUESTION_FIX_PROMPT = "Fix the grammar of the following questions"
+ANSWER_FIX_PROMPT = "Fix the grammar of the following answers"
+
+class StreamingGrammarFix:
+    # Grammar-fixes items as extracted pages deliver them: a request goes out as soon as a chunk's worth
+    # of items has built up, so the fix overlaps OCR of later pages without asking once per page
+    def __init__(self, service, prompt, chunk_items=None):
+        self.service = service
+        self.prompt = prompt
+        self.chunk_items = chunk_items or Config.PROMPT_MAX_ITEMS_PER_CHUNK
+        self.pending = []
+        self.futures = []
+
+    def add(self, items):
+        self.pending.extend(items)
+        if len(self.pending) >= self.chunk_items:
+            self.send()
+
+    def send(self):
+        if self.pending:
+            self.futures.append(async_llm.submit(self.service.chunked_responses_async(
+                "gpt-4o", self.prompt, self.pending, self.service.rewrite_tokens, fallback=str)))
+            self.pending = []
+
+    def results(self):
+        self.send()
+        return [item for future in self.futures for item in future.result()]
+
+    def cancel(self):
+        self.pending = []
+        for future in self.futures:
+            future.cancel()
 
 class FeedbackService:
-    def __init__(self):
-        pass
+    def __init__(self, priority=PRIORITY_BULK):
+        # Rate limiter priority for every upstream call made by this service (PRIORITY_INTERACTIVE goes first)
+        self.priority = priority
     
-    # Input: A list of questions
-    def response_4o(self, prompt, questions, max_tokens=200):
-        client = OpenAI(
-            base_url="https://models.inference.ai.azure.com",
-            api_key=os.environ["GITHUB_TOKEN"],
-        )
+    def build_request(self, prompt, questions):
         request = prompt
         for question in questions:
             request += f"Q: {question}\nA: "
-        try:
-            print("making call to GPT 4o")
-            response = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": ""},
-                    {"role": "user", "content": request}
-                ],
-                model="gpt-4o",
-                temperature=1,
-                max_tokens=max_tokens,
-                top_p=1
-            )
-        except Exception as e:
-            print(f"Error with GPT 4o: {e}")
-            answers = [""] * len(questions)
-            
-        print("received response from GPT 4o")
-        content = response.choices[0].message.content
+        return request
+
+    def parse_answers(self, content):
         try:
             answers = ast.literal_eval(content)
             if not isinstance(answers, list):
                 answers = [content]
         except:
             answers = [content]
-        
         return answers
 
+    def cached_completion(self, model, prompt, questions, temperature, max_tokens, call):
+        """
+        Returns the completion text for this exact request, from the LLM cache when possible.
+        `call` performs the real request and returns the content string.
+        """
+        if not Config.LLM_CACHE_ENABLED:
+            return call()
+
+        key = llm_cache.key(model, prompt, questions, temperature, max_tokens)
+        content = llm_cache.get(model, key)
+        if content is not None:
+            print(f"LLM cache hit for {model}")
+            return content
+
+        start = time.perf_counter()
+        content = call()
+        if content is not None:
+            llm_cache.put(model, key, content, time.perf_counter() - start)
+        return content
+
+    # Input: A list of questions
+    def response_4o(self, prompt, questions, max_tokens=200):
+        def call():
+            client = llm_clients.openai(GITHUB_MODELS_ENDPOINT)
+            print("making call to GPT 4o")
+            request = self.build_request(prompt, questions)
+            def send():
+                with llm_clients.slot(GITHUB_MODELS_ENDPOINT):
+                    return client.chat.completions.create(
+                        messages=[
+                            {"role": "system", "content": ""},
+                            {"role": "user", "content": request}
+                        ],
+                        model="gpt-4o",
+                        temperature=1,
+                        max_tokens=max_tokens,
+                        top_p=1
+                    )
+            response = rate_limiter.call("gpt-4o", send, estimate_tokens(request, max_tokens), self.priority)
+            print("received response from GPT 4o")
+            return response.choices[0].message.content
+
+        try:
+            content = self.cached_completion("gpt-4o", prompt, questions, 1, max_tokens, call)
+        except UpstreamThrottled:
+            raise
+        except Exception as e:
+            print(f"Error with GPT 4o: {e}")
+            return [""] * len(questions)
+        return self.parse_answers(content)
+
     def response_llama(self, prompt, questions, max_tokens=200):
         # azure-ai-inference in requirements.txt
-        
-        client = ChatCompletionsClient(
-            endpoint="https://models.inference.ai.azure.com",
-            credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]),
-        )
-        request = prompt
-        for question in questions:
-            request += f"Q: {question}\nA: "
-        try:
+        def call():
+            client = llm_clients.azure(GITHUB_MODELS_ENDPOINT)
             print("making call to Llama")
-            response = client.complete(
+            request = self.build_request(prompt, questions)
+            def send():
+                with llm_clients.slot(GITHUB_MODELS_ENDPOINT):
+                    return client.complete(
+                        messages=[
+                            SystemMessage(content=""""""),
+                            UserMessage(content=request),
+                        ],
+                        model="Llama-3.3-70B-Instruct",
+                        temperature=0.8,
+                        max_tokens=200,
+                        top_p=0.1
+                    )
+            response = rate_limiter.call("Llama-3.3-70B-Instruct", send, estimate_tokens(request, 200), self.priority)
+            print("received response from Llama")
+            return response.choices[0].message.content
+
+        try:
+            content = self.cached_completion("Llama-3.3-70B-Instruct", prompt, questions, 0.8, 200, call)
+        except UpstreamThrottled:
+            raise
+        except Exception as e:
+            print(f"Error with GPT Llama: {e}")
+            return [""] * len(questions)
+        return self.parse_answers(content)
+
+    def response_mistral(self, prompt, questions, max_tokens=200):
+        def call():
+            client = llm_clients.azure(GITHUB_MODELS_ENDPOINT)
+            print("making call to Mistral")    
+            request = self.build_request(prompt, questions)
+            def send():
+                with llm_clients.slot(GITHUB_MODELS_ENDPOINT):
+                    return client.complete(
+                        messages=[
+                            SystemMessage(content=""""""),
+                            UserMessage(content=request),
+                        ],
+                        model="Mistral-Large-2411",
+                        temperature=0.8,
+                        max_tokens=200,
+                        top_p=0.1
+                    )
+            response = rate_limiter.call("Mistral-Large-2411", send, estimate_tokens(request, 200), self.priority)
+            print("received response from Mistral")
+            return response.choices[0].message.content
+
+        content = self.cached_completion("Mistral-Large-2411", prompt, questions, 0.8, 200, call)
+        return self.parse_answers(content)
+
+    async def cached_completion_async(self, model, prompt, questions, temperature, max_tokens, call, validate=None):
+        """
+        Async twin of cached_completion; the SQLite lookups run off the event loop.
+        With `validate`, cached content that fails it counts as a miss and only content that passes is stored.
+        """
+        if not Config.LLM_CACHE_ENABLED:
+            return await call()
+
+        key = llm_cache.key(model, prompt, questions, temperature, max_tokens)
+        content = await asyncio.to_thread(llm_cache.get, model, key)
+        if content is not None and (validate is None or validate(content)):
+            print(f"LLM cache hit for {model}")
+            return content
+
+        start = time.perf_counter()
+        content = await call()
+        if content is not None and (validate is None or validate(content)):
+            await asyncio.to_thread(llm_cache.put, model, key, content, time.perf_counter() - start)
+        return content
+
+    async def completion_async(self, model, prompt, questions, max_tokens=200, validate=None):
+        # Raw completion text from GPT-4o (OpenAI client) or Llama/Mistral (azure-ai-inference)
+        if model == "gpt-4o":
+            async def call():
+                client = async_llm.openai(GITHUB_MODELS_ENDPOINT)
+                print("making async call to GPT 4o")
+                request = self.build_request(prompt, questions)
+                response = await async_llm.call("gpt-4o", lambda: client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": ""},
+                        {"role": "user", "content": request}
+                    ],
+                    model="gpt-4o",
+                    temperature=1,
+                    max_tokens=max_tokens,
+                    top_p=1
+                ), tokens=estimate_tokens(request, max_tokens), priority=self.priority)
+                print("received response from GPT 4o")
+                return response.choices[0].message.content
+            return await self.cached_completion_async(model, prompt, questions, 1, max_tokens, call, validate)
+
+        async def call():
+            client = async_llm.azure(GITHUB_MODELS_ENDPOINT)
+            print(f"making async call to {model}")
+            request = self.build_request(prompt, questions)
+            response = await async_llm.call(model, lambda: client.complete(
                 messages=[
                     SystemMessage(content=""""""),
                     UserMessage(content=request),
                 ],
-                model="Llama-3.3-70B-Instruct",
+                model=model,
                 temperature=0.8,
-                max_tokens=200,
+                max_tokens=max_tokens,
                 top_p=0.1
-            )
-        except Exception as e:
-            print(f"Error with GPT Llama: {e}")
-            answers = [""] * len(questions)
-                
-        print("received response from Llama")
-        content = response.choices[0].message.content
-        try:
-            answers = ast.literal_eval(content)
-            if not isinstance(answers, list):
-                answers = [content]
-        except:
-            answers = [content]
-        return answers
+            ), tokens=estimate_tokens(request, max_tokens), priority=self.priority)
+            print(f"received response from {model}")
+            return response.choices[0].message.content
+        return await self.cached_completion_async(model, prompt, questions, 0.8, max_tokens, call, validate)
 
+    def chunked_responses(self, model, prompt, items, output_per_item, fallback=None):
+        # Sync wrapper for the grammar-fix stages running on pipeline threads
+        return async_llm.run(self.chunked_responses_async(model, prompt, items, output_per_item, fallback))
 
-    def response_mistral(self, prompt, questions, max_tokens=200):
-        client = ChatCompletionsClient(
-            endpoint="https://models.inference.ai.azure.com",
-            credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]),
-        )
+    async def chunked_responses_async(self, model, prompt, items, output_per_item, fallback=None):
+        """Runs `prompt` over `items` in chunks that fit the model's limits; one result per item, in order."""
+        if not items:
+            return []
+        chunks = prompt_planner.plan(model, prompt, items, output_per_item)
+        indexed_prompt = prompt_planner.indexed_prompt(prompt)
+        if len(chunks) > 1:
+            print(f"split {len(items)} items into {len(chunks)} chunks for {model}")
 
-        request = prompt
-        for question in questions:
-            request += f"Q: {question}\nA: "
-        print("making call to Mistral")    
-        response = client.complete(
-            messages=[
-                SystemMessage(content=""""""),
-                UserMessage(content=request),
-            ],
-            model="Mistral-Large-2411",
-            temperature=0.8,
-            max_tokens=200,
-            top_p=0.1
-        )
-        print("received response from Mistral")
-        content = response.choices[0].message.content
-        try:
-            answers = ast.literal_eval(content)
-            if not isinstance(answers, list):
-                answers = [content]
-        except:
-            answers = [content]
-        return answers
+        # Chunks go out PROMPT_CHUNK_CONCURRENCY at a time, so each one only joins the rate limiter queue
+        # (and starts its RATE_LIMIT_MAX_WAIT clock) once it is about to be sent
+        wave = asyncio.Semaphore(Config.PROMPT_CHUNK_CONCURRENCY)
+
+        async def run_chunk(chunk):
+            async with wave:
+                return await ask_chunk(chunk)
+
+        async def ask_chunk(chunk):
+            indices = [index for index, _ in chunk]
+            max_tokens = prompt_planner.output_budget(model, chunk, output_per_item)
+            valid = lambda content: prompt_planner.parse_indexed(content, indices) is not None
+            for attempt in range(Config.PROMPT_CHUNK_RETRIES + 1):
+                # Retries tag the prompt so neither the cache nor the provider replays the bad output
+                chunk_prompt = indexed_prompt if not attempt else f"(retry {attempt}) {indexed_prompt}"
+                try:
+                    content = await self.completion_async(model, chunk_prompt, prompt_planner.indexed_items(chunk),
+                                                          max_tokens, valid)
+                except asyncio.CancelledError:
+                    raise
+                except UpstreamThrottled:
+                    if fallback is None:
+                        raise
+                    # Items with a fallback (e.g. the unfixed text) don't fail the whole call
+                    print(f"{model} still throttled on items {indices[0]}-{indices[-1]}, using the fallback")
+                    return {}
+                except Exception as e:
+                    print(f"Error with {model} on items {indices[0]}-{indices[-1]}: {e}")
+                    continue
+                parsed = prompt_planner.parse_indexed(content, indices)
+                if parsed is not None:
+                    return parsed
+                print(f"{model} returned unusable output for items {indices[0]}-{indices[-1]}, retrying")
+            return {}
+
+        parsed_chunks = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        merged = {}
+        for parsed in parsed_chunks:
+            merged.update(parsed)
+        return [merged[index] if index in merged else (fallback(item) if fallback else "")
+                for index, item in enumerate(items)]
+
+    def answer_tokens(self, question):
+        # Model answers are asked for in ~150 words
+        return Config.ANSWER_TOKENS_PER_QUESTION
+
+    def rewrite_tokens(self, text):
+        # A grammar fix is about as long as its input, with some slack
+        return int(prompt_planner.count_tokens(str(text)) * 1.3) + 16
 
     def similarity_score(self,answer_1, answer_2):
         print("calculating similarity score")
-        model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-        embeddings = model.encode([answer_1, answer_2])
-        similarity_score = util.cos_sim(embeddings[0], embeddings[1])
-        return similarity_score.item()
+        return embedding_service.similarity(answer_1, answer_2)
 
     def combine_responses(self,responses):
-        combined_text = "\n".join(responses)
-        client = OpenAI(api_key=os.environ["GITHUB_TOKEN"])
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "system", 
-                "content": "Combine the following responses into a coherent and meaningful answer:"
-                },
-                {"role": "user", 
-                "content": combined_text
-                }
-            ],
-            model="gpt-4o-mini",
-            temperature=1,
-            max_tokens=200,
-            top_p=1
-        )
-        return response.choices[0].message.content
+        system_prompt = "Combine the following responses into a coherent and meaningful answer:"
+        def call():
+            combined_text = "\n".join(responses)
+            client = llm_clients.openai(OPENAI_ENDPOINT)
+            def send():
+                with llm_clients.slot(OPENAI_ENDPOINT):
+                    return client.chat.completions.create(
+                        messages=[
+                            {"role": "system", 
+                            "content": system_prompt
+                            },
+                            {"role": "user", 
+                            "content": combined_text
+                            }
+                        ],
+                        model="gpt-4o-mini",
+                        temperature=1,
+                        max_tokens=200,
+                        top_p=1
+                    )
+            response = rate_limiter.call("gpt-4o-mini", send, estimate_tokens(combined_text, 200), self.priority)
+            return response.choices[0].message.content
+        return self.cached_completion("gpt-4o-mini", system_prompt, responses, 1, 200, call)
 
-    def multimodel_responses(self, questions):
-        threshold_sim = 0.75
-        prompt = "Answer the following questions and return the output as an\
-        array of answers for their respective questions at their respective indices. Write each answer in around 150 words:\n"
+    def align_answers(self, answers, n):
+        # Models don't always return exactly one answer per question; pad/trim so indices line up
+        answers = [str(answer) if answer is not None else "" for answer in answers[:n]]
+        return answers + [""] * (n - len(answers))
+
+    def collect_model_answers(self, questions, early_exit=None, threshold_sim=0.75):
+        # Sync entry point for Flask routes and pipeline threads; the fan-out runs on the async loop
+        return async_llm.run(self.collect_model_answers_async(questions, early_exit, threshold_sim),
+                             timeout=Config.LLM_HARD_TIMEOUT + 5)
+
+    async def collect_model_answers_async(self, questions, early_exit=None, threshold_sim=0.75):
+        """Fans the questions out to the three models and returns {model: answers or None}."""
+        early_exit = Config.CONSENSUS_EARLY_EXIT if early_exit is None else early_exit
+        prompt = "Answer the following questions. Write each answer in around 150 words:\n"
         tasks = {
-            'gpt-4o': lambda: self.response_4o(prompt, questions),
-            'llama': lambda: self.response_llama(prompt, questions),
-            'mistral': lambda: self.response_mistral(prompt, questions)
+            'gpt-4o': lambda: self.chunked_responses_async("gpt-4o", prompt, questions, self.answer_tokens),
+            'llama': lambda: self.chunked_responses_async("Llama-3.3-70B-Instruct", prompt, questions, self.answer_tokens),
+            'mistral': lambda: self.chunked_responses_async("Mistral-Large-2411", prompt, questions, self.answer_tokens)
         }
 
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        give_up_at = start + Config.LLM_HARD_TIMEOUT
+        attempts = {model_name: 0 for model_name in tasks}
+        hedge_at = {model_name: start + Config.LLM_DEADLINES.get(model_name, Config.LLM_HARD_TIMEOUT) for model_name in tasks}
+        task_to_model = {}
         results = {}
+        throttled = None
 
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_model = {executor.submit(task): model for model, task in tasks.items()}
-            for future in as_completed(future_to_model):
-                model_name = future_to_model[future]
-                try:
-                    results[model_name] = future.result()
-                except Exception as e:
-                    print(f"{model_name} failed with error: {e}")
-                    results[model_name] = [""] * len(questions)
+        def launch(model_name):
+            attempts[model_name] += 1
+            task_to_model[asyncio.ensure_future(tasks[model_name]())] = model_name
 
-        answers_4o = results['gpt-4o']
-        answers_llama = results['llama']
-        answers_mistral = results['mistral']
-        
-        final_answers = []
+        for model_name in tasks:
+            launch(model_name)
+
+        try:
+            while len(results) < len(tasks):
+                now = loop.time()
+                if now >= give_up_at:
+                    print(f"giving up on {[m for m in tasks if m not in results]} after {Config.LLM_HARD_TIMEOUT}s")
+                    break
+
+                for model_name in tasks:
+                    if model_name not in results and now >= hedge_at[model_name] and attempts[model_name] <= Config.LLM_MAX_HEDGES:
+                        print(f"{model_name} is past its deadline, sending a hedged request")
+                        launch(model_name)
+                        hedge_at[model_name] = now + Config.LLM_DEADLINES.get(model_name, Config.LLM_HARD_TIMEOUT)
+
+                waiting = [task for task, model_name in task_to_model.items() if model_name not in results]
+                wake_up = [give_up_at] + [hedge_at[m] for m in tasks if m not in results and attempts[m] <= Config.LLM_MAX_HEDGES]
+                done, _ = await asyncio.wait(waiting, timeout=max(0.0, min(wake_up) - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    model_name = task_to_model.pop(task)
+                    if model_name in results:
+                        continue
+                    try:
+                        answers = self.align_answers(task.result(), len(questions))
+                    except Exception as e:
+                        print(f"{model_name} failed with error: {e}")
+                        if isinstance(e, UpstreamThrottled):
+                            throttled = e
+                        answers = None
+                    if answers is not None and not any(answer.strip() for answer in answers):
+                        answers = None
+                    if answers is not None or not any(m == model_name for m in task_to_model.values()):
+                        # Keep waiting on a hedged copy if this attempt failed but another is in flight
+                        results[model_name] = answers
+
+                if early_exit and len(results) < len(tasks) and \
+                        await asyncio.to_thread(self.has_consensus, results, threshold_sim):
+                    print(f"consensus reached without {[m for m in tasks if m not in results]}")
+                    break
+        finally:
+            # Early exit, timeout or our own cancellation: abort whatever is still in flight
+            for task in task_to_model:
+                task.cancel()
+        if throttled is not None and all(results.get(model_name) is None for model_name in tasks):
+            # Every provider is throttled: fail loudly instead of grading against empty answers
+            raise throttled
+        return {model_name: results.get(model_name) for model_name in tasks}
+
+    def has_consensus(self, answer_sets, threshold_sim=0.75):
+        # True when, for every question, some pair of the answers received so far agrees
+        available = [answers for answers in answer_sets.values() if answers is not None]
+        if len(available) < 2:
+            return False
+        n = len(available[0])
+        embeddings = embedding_service.encode_many([answer for answers in available for answer in answers])
+        sets = [embeddings[k * n:(k + 1) * n] for k in range(len(available))]
+        agreed = np.zeros(n, dtype=bool)
+        for a in range(len(sets)):
+            for b in range(a + 1, len(sets)):
+                agreed |= np.sum(sets[a] * sets[b], axis=1) >= threshold_sim
+        return bool(agreed.all())
 
-        for i in range(len(questions)):
-            answer_4o = answers_4o[i]
-            answer_llama = answers_llama[i]
-            answer_mistral = answers_mistral[i]
-
-            sim_4o_llama = self.similarity_score(answer_4o, answer_llama)
-            sim_4o_mistral = self.similarity_score(answer_4o, answer_mistral)
-            sim_llama_mistral = self.similarity_score(answer_llama, answer_mistral)
-            print("sim_4o_llama", sim_4o_llama)
-            print("sim_4o_mistral", sim_4o_mistral)
-            print("sim_llama_mistral", sim_llama_mistral)
-            if sim_4o_llama >= threshold_sim and sim_4o_llama > sim_4o_mistral and sim_4o_llama > sim_llama_mistral:
-                final_answers.append(answer_4o)
-            elif sim_4o_mistral >= threshold_sim and sim_4o_mistral > sim_4o_llama and sim_4o_mistral > sim_llama_mistral:
-                final_answers.append(answer_4o)
-            elif sim_llama_mistral >= threshold_sim and sim_llama_mistral > sim_4o_llama and sim_llama_mistral > sim_4o_mistral:
-                final_answers.append(answer_llama)
+    def embed_answer_sets(self, answer_sets, n, extra_texts=()):
+        """
+        Embeds every available model answer plus `extra_texts` in one encode call.
+        Returns ({model: (n, dim) embeddings}, extra embeddings); missing models get zero rows.
+        """
+        texts = []
+        for model_name in CONSENSUS_MODELS:
+            if answer_sets.get(model_name) is not None:
+                texts.extend(answer_sets[model_name])
+        texts.extend(extra_texts)
+        embeddings = embedding_service.encode_many(texts) if texts else np.zeros((0, 1), dtype=np.float32)
+        dim = embeddings.shape[1] if embeddings.size else 1
+
+        model_embeddings = {}
+        offset = 0
+        for model_name in CONSENSUS_MODELS:
+            if answer_sets.get(model_name) is not None:
+                model_embeddings[model_name] = embeddings[offset:offset + n]
+                offset += n
             else:
-                combined = self.combine_responses([answer_4o, answer_llama, answer_mistral])
-                final_answers.append(combined)
+                model_embeddings[model_name] = np.zeros((n, dim), dtype=np.float32)
+        return model_embeddings, embeddings[offset:]
+
+    def consensus_choices(self, emb_4o, emb_llama, emb_mistral, threshold_sim=0.75, available=(True, True, True)):
+        """Returns (choices, pair_sims) for every question from the pairwise model answer similarities."""
+        pair_sims = np.stack([
+            np.sum(emb_4o * emb_llama, axis=1),
+            np.sum(emb_4o * emb_mistral, axis=1),
+            np.sum(emb_llama * emb_mistral, axis=1),
+        ], axis=1)
+        has_4o, has_llama, has_mistral = available
+        pair_available = np.array([has_4o and has_llama, has_4o and has_mistral, has_llama and has_mistral])
+        pair_sims[:, ~pair_available] = -np.inf
+
+        best_pair = pair_sims.argmax(axis=1)
+        best_sim = pair_sims.max(axis=1)
+        # A pair only wins if it clears the threshold and strictly beats the other two pairs
+        unique_best = np.sum(pair_sims == best_sim[:, None], axis=1) == 1
+        agreed = (best_sim >= threshold_sim) & unique_best
+
+        choices = np.where(best_pair == 2, CONSENSUS_LLAMA, CONSENSUS_4O)
+        choices[~agreed] = CONSENSUS_COMBINE
+        return choices, pair_sims
+
+    def resolve_consensus(self, answer_sets, choices):
+        final_answers = []
+        for i, choice in enumerate(choices):
+            if choice == CONSENSUS_REFERENCE:
+                final_answers.append(answer_sets['reference'][i])
+            elif choice == CONSENSUS_4O:
+                final_answers.append(answer_sets['gpt-4o'][i])
+            elif choice == CONSENSUS_LLAMA:
+                final_answers.append(answer_sets['llama'][i])
+            else:
+                candidates = [answer_sets[m][i] for m in CONSENSUS_MODELS if answer_sets.get(m) is not None]
+                if len(candidates) > 1:
+                    final_answers.append(self.combine_responses(candidates))
+                else:
+                    final_answers.append(candidates[0] if candidates else "")
+        return final_answers
+
+    def reference_scope(self, questions, exam_id=None):
+        """
+        Reference answers are only reused within one exam answered by the same models. The exam is the
+        caller's exam id, or else a fingerprint of its (normalized, sorted) questions.
+        """
+        if not exam_id:
+            normalized = "\n".join(sorted(embedding_service.normalize(question) for question in questions))
+            exam_id = "questions:" + hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{','.join(CONSENSUS_MODELS)}|{exam_id}"
+
+    def reference_answer_sets(self, questions, threshold_sim=0.75, scope=None):
+        """Model answer sets for `questions`, reusing answers from the reference index within `scope`."""
+        n = len(questions)
+        scope = scope or self.reference_scope(questions)
+        reference = reference_index.lookup(questions, scope) if Config.REFERENCE_INDEX_ENABLED else [None] * n
+        missing = [i for i, answer in enumerate(reference) if answer is None]
+        if len(missing) < n:
+            print(f"reusing reference answers for {n - len(missing)} of {n} questions")
+
+        answer_sets = {model_name: None for model_name in CONSENSUS_MODELS}
+        if missing:
+            partial = self.collect_model_answers([questions[i] for i in missing], threshold_sim=threshold_sim)
+            for model_name in CONSENSUS_MODELS:
+                if partial[model_name] is not None:
+                    answers = [""] * n
+                    for i, answer in zip(missing, partial[model_name]):
+                        answers[i] = answer
+                    answer_sets[model_name] = answers
+        answer_sets['reference'] = reference
+        return answer_sets
+
+    def remember_reference_answers(self, questions, model_answers, choices, pair_sims, threshold_sim=0.75, scope=None):
+        # Only answers at least two models agreed on are trusted for reuse across students of the same exam
+        if not Config.REFERENCE_INDEX_ENABLED:
+            return
+        scope = scope or self.reference_scope(questions)
+        agreed = pair_sims.max(axis=1) >= threshold_sim if len(pair_sims) else np.zeros(0, dtype=bool)
+        validated = [i for i, choice in enumerate(choices) if agreed[i] and choice != CONSENSUS_REFERENCE]
+        added = reference_index.add([questions[i] for i in validated], [model_answers[i] for i in validated],
+                                    source="consensus", scope=scope)
+        if added:
+            print(f"indexed {added} new reference answers")
+
+    def apply_reference_answers(self, answer_sets, choices):
+        reference = answer_sets.get('reference') or []
+        for i, answer in enumerate(reference):
+            if answer is not None:
+                choices[i] = CONSENSUS_REFERENCE
+        return choices
+
+    def multimodel_responses(self, questions):
+        threshold_sim = 0.75
+        answer_sets = self.reference_answer_sets(questions, threshold_sim=threshold_sim)
+        n = len(questions)
+        embeddings, _ = self.embed_answer_sets(answer_sets, n)
+        available = tuple(answer_sets[m] is not None for m in CONSENSUS_MODELS)
+        choices, pair_sims = self.consensus_choices(
+            embeddings['gpt-4o'], embeddings['llama'], embeddings['mistral'], threshold_sim, available)
+        print("pairwise similarities (4o/llama, 4o/mistral, llama/mistral)", pair_sims.tolist())
+        choices = self.apply_reference_answers(answer_sets, choices)
+        final_answers = self.resolve_consensus(answer_sets, choices)
+        self.remember_reference_answers(questions, final_answers, choices, pair_sims, threshold_sim)
         return final_answers
 
+    def grade_answers(self, questions, student_answers, answer_sets, threshold_sim=0.75, threshold_correct=0.8):
+        """Scores every question of the exam from one batch of embeddings."""
+        n = len(questions)
+        student_answers = self.align_answers(student_answers, n)
+        if n == 0:
+            empty = np.zeros(0, dtype=int)
+            return {"model_answers": [], "choices": empty, "pair_similarities": np.zeros((0, 3)),
+                    "similarity_scores": np.zeros(0), "correct_mask": np.zeros(0, dtype=bool),
+                    "correct_indices": empty, "wrong_indices": empty}
+
+        embeddings, emb_student = self.embed_answer_sets(answer_sets, n, student_answers)
+        emb_4o, emb_llama, emb_mistral = (embeddings[m] for m in CONSENSUS_MODELS)
+        available = tuple(answer_sets.get(m) is not None for m in CONSENSUS_MODELS)
+
+        choices, pair_sims = self.consensus_choices(emb_4o, emb_llama, emb_mistral, threshold_sim, available)
+        choices = self.apply_reference_answers(answer_sets, choices)
+        model_answers = self.resolve_consensus(answer_sets, choices)
+
+        model_embeddings = np.where((choices == CONSENSUS_LLAMA)[:, None], emb_llama, emb_4o)
+        reencode_indices = np.flatnonzero((choices == CONSENSUS_COMBINE) | (choices == CONSENSUS_REFERENCE))
+        if reencode_indices.size:
+            model_embeddings[reencode_indices] = embedding_service.encode_many(
+                [model_answers[i] for i in reencode_indices])
+
+        similarity_scores = np.sum(emb_student * model_embeddings, axis=1)
+        correct_mask = similarity_scores >= threshold_correct
+        return {
+            "model_answers": model_answers,
+            "choices": choices,
+            "pair_similarities": pair_sims,
+            "similarity_scores": similarity_scores,
+            "correct_mask": correct_mask,
+            "correct_indices": np.flatnonzero(correct_mask),
+            "wrong_indices": np.flatnonzero(~correct_mask),
+        }
+
     def generate_feedback(self, wrong_questions, wrong_student_answers, correct_questions, correct_student_answers, model_answers, model_choice):    
         prompt = f"You are a helpful tutor. Provide constructive feedback on the student's answer. The student has answered the following questions incorrectly:"
         for i in range(len(wrong_questions)):
@@ -227,57 +625,188 @@ class FeedbackService:
         return questions, answers
 
     def get_topics(self, questions):
-        topics = []
-        for question in questions:
-            topics.append(self.response_4o("Give a list of topics that the question is related to", [question]))
+        """Topic tags for every question, asked for in batches of TOPIC_BATCH_SIZE."""
+        if not questions:
+            return []
+
+        topics = [None] * len(questions)
+        batch_size = Config.TOPIC_BATCH_SIZE
+        indices = list(range(len(questions)))
+        workers = min(Config.TOPIC_CONCURRENCY, -(-len(questions) // batch_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self.ask_topic_batches(executor, questions, topics, indices, batch_size)
+
+            missing = [i for i in indices if topics[i] is None]
+            if missing:
+                print(f"re-asking topics for {len(missing)} questions in smaller batches")
+                self.ask_topic_batches(executor, questions, topics, missing, max(1, batch_size // 2))
+
+            missing = [i for i in indices if topics[i] is None]
+            if missing:
+                print(f"re-asking topics for questions {missing} one at a time")
+                single = lambda i: self.response_4o("Give a list of topics that the question is related to", [questions[i]])
+                for i, question_topics in zip(missing, executor.map(single, missing)):
+                    topics[i] = question_topics
         return topics
-    
-    def feedback_route(self, pdf, model_choice):
+
+    def ask_topic_batches(self, executor, questions, topics, indices, batch_size):
+        # Fills topics[i] for the given question indices from batched calls of batch_size questions
+        groups = [indices[start:start + batch_size] for start in range(0, len(indices), batch_size)]
+        results = executor.map(lambda group: self.topics_for_chunk([questions[i] for i in group]), groups)
+        for group, group_topics in zip(groups, results):
+            for i, question_topics in zip(group, group_topics):
+                topics[i] = question_topics
+
+    def topics_for_chunk(self, questions):
+        prompt = "For each numbered question below, list the topics it is related to. Return only a JSON array\
+        with one entry per question in the same order, each entry being [question number, [topic, ...]]:\n"
+        for number, question in enumerate(questions, start=1):
+            prompt += f"{number}. {question}\n"
+        answers = self.response_4o(prompt, [], max_tokens=40 * len(questions) + 50)
+        return self.parse_topic_batch(answers, len(questions))
+
+    def parse_topic_batch(self, answers, count):
+        """
+        Maps the batched topic output back onto question positions; anything we can't
+        attribute to a question with confidence is left as None.
+        """
+        if len(answers) == 1 and isinstance(answers[0], str):
+            # literal_eval failed on the raw text: pull the outermost JSON array out of any surrounding prose
+            content = answers[0]
+            try:
+                answers = json.loads(content[content.index("["):content.rindex("]") + 1])
+            except ValueError:
+                return [None] * count
+
+        topics = [None] * count
+        for position, entry in enumerate(answers):
+            if isinstance(entry, (list, tuple)) and len(entry) == 2 and isinstance(entry[0], int) and isinstance(entry[1], (list, tuple)):
+                index, entry_topics = entry[0] - 1, entry[1]
+            elif isinstance(entry, (list, tuple)) and len(answers) == count:
+                index, entry_topics = position, entry
+            else:
+                continue
+            if 0 <= index < count and all(isinstance(topic, str) for topic in entry_topics):
+                topics[index] = [topic.strip() for topic in entry_topics]
+        return topics
+
+    def report_progress(self, progress, stage, **details):
+        if progress is not None:
+            progress(stage, **details)
+
+    def extract_exam(self, pdf, progress=None, on_page=None):
         inference = DataExtraction()
-        question_answer_dict = inference.data_extraction(pdf)
+        # Pages come out of the streaming pipeline as they finish, each reported as it lands;
+        # `on_page(questions, answers)` lets LLM work on a page start before the last page is OCRed
+        for _, entries in inference.stream_extraction(pdf, progress=progress):
+            if on_page is not None:
+                on_page([entry["question"] for entry in entries], [entry["answer"] for entry in entries])
         print("received question_answer_dict")
-        questions, student_answers = self.extract_questions_answers(question_answer_dict)
+        questions, student_answers = self.extract_questions_answers(inference.question_answer_dict)
         print("extracted questions and student answers")
-        
-        q_prompt = "Fix the grammar of the following questions and return the corrected questions in an array in the same order"
-        a_prompt = "Fix the grammar of the following answers and return the corrected answers in an array in the same order"
-        
-        fixed_questions = self.response_4o(q_prompt, questions)
-        fixed_answers = self.response_4o(a_prompt, student_answers)
-        questions = fixed_questions
-        student_answers = fixed_answers
-        model_answers = self.multimodel_responses(questions)
-        print("received final answers from model(s)")
-
-        wrong_questions = []
-        wrong_student_answers = []
-        similarity_scores = []
-        
-        correct_questions = []
-        correct_student_answers = []
-        for i in range(len(questions)):
-            sim_score = self.similarity_score(student_answers[i], model_answers[i])
-            similarity_scores.append(sim_score)
-            if sim_score < 0.8:
-                wrong_student_answers.append(student_answers[i])
-                wrong_questions.append(questions[i])
-            elif sim_score >= 0.8:
-                correct_questions.append(questions[i])
-                correct_student_answers.append(student_answers[i])
-        
-        feedback = self.generate_feedback(wrong_questions, wrong_student_answers, correct_questions, correct_student_answers, model_answers, model_choice)        
-        
-        wrong_topics = self.get_topics(wrong_questions)
-        correct_topics = self.get_topics(correct_questions)
+        page_sources = inference.text_layer_stats()
+        self.report_progress(progress, "extraction", **page_sources)
+        return questions, student_answers, page_sources
+
+    def split_by_grade(self, questions, student_answers, grading):
+        student_answers = self.align_answers(student_answers, len(questions))
+        return {
+            "model_answers": grading["model_answers"],
+            "wrong_questions": [questions[i] for i in grading["wrong_indices"]],
+            "wrong_student_answers": [student_answers[i] for i in grading["wrong_indices"]],
+            "correct_questions": [questions[i] for i in grading["correct_indices"]],
+            "correct_student_answers": [student_answers[i] for i in grading["correct_indices"]],
+        }
+
+    def build_feedback_graph(self, pdf, model_choice, progress=None, exam_id=None):
+        """feedback_route as a StageGraph, so independent steps run side by side."""
+        question_fix = StreamingGrammarFix(self, QUESTION_FIX_PROMPT)
+        answer_fix = StreamingGrammarFix(self, ANSWER_FIX_PROMPT)
+
+        def extract():
+            def on_page(questions, student_answers):
+                question_fix.add(questions)
+                answer_fix.add(student_answers)
+            try:
+                return self.extract_exam(pdf, progress, on_page)
+            except Exception:
+                question_fix.cancel()
+                answer_fix.cancel()
+                raise
+
+        def fix_questions(extract):
+            questions = question_fix.results()
+            self.report_progress(progress, "grammar_fix", questions=questions)
+            return questions
+
+        def fix_answers(extract):
+            student_answers = answer_fix.results()
+            self.report_progress(progress, "grammar_fix", student_answers=student_answers)
+            return student_answers
+
+        def model_answers(fix_questions):
+            answer_sets = self.reference_answer_sets(fix_questions, scope=self.reference_scope(fix_questions, exam_id))
+            print("received answers from model(s)")
+            self.report_progress(progress, "model_answers", answers=answer_sets)
+            return answer_sets
+
+        def grading(fix_questions, fix_answers, model_answers):
+            scores = self.grade_answers(fix_questions, fix_answers, model_answers)
+            self.remember_reference_answers(fix_questions, scores["model_answers"], scores["choices"],
+                                            scores["pair_similarities"], scope=self.reference_scope(fix_questions, exam_id))
+            print("scored student answers")
+            self.report_progress(progress, "similarity",
+                                 model_answers=scores["model_answers"],
+                                 similarity_scores=scores["similarity_scores"].tolist(),
+                                 correct_indices=scores["correct_indices"].tolist(),
+                                 wrong_indices=scores["wrong_indices"].tolist())
+            return self.split_by_grade(fix_questions, fix_answers, scores)
+
+        def feedback(grading):
+            text = self.generate_feedback(grading["wrong_questions"], grading["wrong_student_answers"],
+                                          grading["correct_questions"], grading["correct_student_answers"],
+                                          grading["model_answers"], model_choice)
+            self.report_progress(progress, "feedback", feedback=text)
+            return text
+
+        def wrong_topics(grading):
+            topics = self.get_topics(grading["wrong_questions"])
+            self.report_progress(progress, "topics", wrong_topics=topics)
+            return topics
+
+        def correct_topics(grading):
+            topics = self.get_topics(grading["correct_questions"])
+            self.report_progress(progress, "topics", correct_topics=topics)
+            return topics
+
+        graph = StageGraph()
+        graph.add("extract", extract)
+        graph.add("fix_questions", fix_questions, deps=["extract"])
+        graph.add("fix_answers", fix_answers, deps=["extract"])
+        graph.add("model_answers", model_answers, deps=["fix_questions"])
+        graph.add("grading", grading, deps=["fix_questions", "fix_answers", "model_answers"])
+        graph.add("feedback", feedback, deps=["grading"])
+        graph.add("wrong_topics", wrong_topics, deps=["grading"])
+        graph.add("correct_topics", correct_topics, deps=["grading"])
+        return graph
+
+    def feedback_route(self, pdf, model_choice, progress=None, exam_id=None):
+        graph = self.build_feedback_graph(pdf, model_choice, progress, exam_id)
+        results = graph.run()
+        critical_time, critical_path = graph.critical_path()
+        print(f"feedback pipeline took {graph.wall_time}s, critical path {critical_time}s ({' -> '.join(critical_path)})")
 
+        grading = results["grading"]
         result = {
-            "feedback":feedback,
-            "wrong_questions":wrong_questions,
-            "wrong_student_answers":wrong_student_answers,
-            "correct_questions":correct_questions,
-            "correct_student_answers": correct_student_answers,
-            "wrong_topics":wrong_topics,
-            "correct_topics":correct_topics
+            "feedback":results["feedback"],
+            "wrong_questions":grading["wrong_questions"],
+            "wrong_student_answers":grading["wrong_student_answers"],
+            "correct_questions":grading["correct_questions"],
+            "correct_student_answers": grading["correct_student_answers"],
+            "wrong_topics":results["wrong_topics"],
+            "correct_topics":results["correct_topics"],
+            "page_sources": results["extract"][2],
+            "stage_timings": graph.timings
         }
         return result
 
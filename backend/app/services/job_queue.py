@@ -0,0 +1,127 @@
+import time
+import uuid
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+
+class JobQueue:
+    """Runs long grading requests on background threads and keeps their progress and results."""
+    def __init__(self, workers=None, result_ttl=None):
+        self.workers = workers or Config.GRADING_WORKERS
+        self.result_ttl = result_ttl if result_ttl is not None else Config.JOB_RESULT_TTL
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="grading-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def submit(self, fn, *args, **kwargs):
+        self._cleanup()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "stage": None,
+                "completed_stages": [],
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "events": [],
+            }
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _record_event(self, job_id, stage, data, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            started = job["started_at"] or time.time()
+            job["events"].append({
+                "id": len(job["events"]),
+                "stage": stage,
+                "elapsed": round(time.time() - started, 3),
+                "data": data,
+            })
+            self._changed.notify_all()
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status="running", started_at=time.time())
+
+        def progress(stage, **details):
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job["stage"] = stage
+                    job["completed_stages"].append(stage)
+            self._record_event(job_id, stage, details)
+
+        try:
+            result = fn(*args, progress=progress, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self._record_event(job_id, "failed", {"error": str(e)},
+                               status="failed", error=str(e), finished_at=time.time())
+            return
+        self._record_event(job_id, "completed", {"result": result},
+                           status="completed", result=result, finished_at=time.time())
+
+    def events(self, job_id, start=0, keepalive=15):
+        """
+        Generator over a job's events from index `start`, blocking until new ones arrive.
+        Yields None every `keepalive` seconds without news and stops after the final event.
+        """
+        index = start
+        while True:
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                if index >= len(job["events"]) and job["finished_at"] is None:
+                    self._changed.wait(timeout=keepalive)
+                new_events = job["events"][index:]
+                finished = job["finished_at"] is not None
+            if not new_events:
+                if finished:
+                    return
+                yield None
+                continue
+            for event in new_events:
+                yield event
+            index += len(new_events)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = dict(job)
+            snapshot["completed_stages"] = list(job["completed_stages"])
+            del snapshot["events"]
+        started = snapshot["started_at"] or time.time()
+        finished = snapshot["finished_at"] or time.time()
+        snapshot["elapsed"] = round(finished - started, 3) if snapshot["started_at"] else 0.0
+        return snapshot
+
+    def _cleanup(self):
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+grading_jobs = JobQueue()
@@ -0,0 +1,142 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from collections import OrderedDict, defaultdict
+from app.services import sqlite_db
+from config import Config
+
+
+class LLMResponseCache:
+    """Memory + SQLite cache of LLM completions."""
+    def __init__(self, db_path=None, memory_entries=None, ttl=None, max_bytes=None):
+        self.db_path = db_path or Config.LLM_CACHE_PATH
+        self.memory_entries = memory_entries if memory_entries is not None else Config.LLM_CACHE_MEMORY_ENTRIES
+        self.ttl = ttl if ttl is not None else Config.LLM_CACHE_TTL
+        self.max_bytes = max_bytes if max_bytes is not None else Config.LLM_CACHE_MAX_BYTES
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._stats = defaultdict(lambda: {"hits": 0, "misses": 0, "saved_seconds": 0.0})
+
+    def key(self, model, prompt, questions, temperature, max_tokens):
+        payload = json.dumps([model, prompt, list(questions), temperature, max_tokens], default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connection(self):
+        # Called with self._lock held
+        if self._db is None:
+            self._db = sqlite_db.connect(
+                self.db_path,
+                "CREATE TABLE IF NOT EXISTS llm_responses ("
+                " key TEXT PRIMARY KEY, model TEXT, content TEXT, latency REAL,"
+                " size INTEGER, created_at REAL, last_access REAL)",
+                "CREATE INDEX IF NOT EXISTS llm_responses_last_access ON llm_responses (last_access)",
+            )
+        return self._db
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _expired(self, created_at):
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def get(self, model, key):
+        with self._lock:
+            stats = self._stats[model]
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry["created_at"]):
+                self._memory.move_to_end(key)
+                stats["hits"] += 1
+                stats["saved_seconds"] += entry["latency"]
+                return entry["content"]
+            self._memory.pop(key, None)
+
+            try:
+                db = self._connection()
+                row = db.execute("SELECT content, latency, created_at FROM llm_responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and self._expired(row[2]):
+                    db.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                    db.commit()
+                    row = None
+                if row is not None:
+                    db.execute("UPDATE llm_responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                    db.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache read failed: {e}")
+                row = None
+
+            if row is None:
+                stats["misses"] += 1
+                return None
+
+            content, latency, created_at = row
+            self._remember(key, {"content": content, "latency": latency, "created_at": created_at})
+            stats["hits"] += 1
+            stats["saved_seconds"] += latency
+            return content
+
+    def put(self, model, key, content, latency):
+        now = time.time()
+        with self._lock:
+            self._remember(key, {"content": content, "latency": latency, "created_at": now})
+            try:
+                db = self._connection()
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_responses (key, model, content, latency, size, created_at, last_access)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model, content, latency, len(content.encode("utf-8")), now, now)
+                )
+                db.commit()
+                self._evict(db)
+            except sqlite3.Error as e:
+                print(f"LLM cache write failed: {e}")
+
+    def _evict(self, db):
+        if self.ttl > 0:
+            db.execute("DELETE FROM llm_responses WHERE created_at < ?", (time.time() - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+        if total > self.max_bytes:
+            # Least recently used rows first, down to 90% of max_bytes so the next writes don't evict again
+            excess = total - int(self.max_bytes * 0.9)
+            freed = 0
+            stale = []
+            for key, size in db.execute("SELECT key, size FROM llm_responses ORDER BY last_access"):
+                if freed >= excess:
+                    break
+                stale.append((key,))
+                freed += size
+            db.executemany("DELETE FROM llm_responses WHERE key = ?", stale)
+        db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._stats.clear()
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM llm_responses")
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache clear failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            report = {}
+            for model, stats in self._stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                report[model] = {
+                    "hits": stats["hits"],
+                    "misses": stats["misses"],
+                    "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+                    "saved_seconds": round(stats["saved_seconds"], 3),
+                }
+            return report
+
+
+llm_cache = LLMResponseCache()
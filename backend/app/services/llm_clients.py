@@ -0,0 +1,78 @@
+import os
+import threading
+import httpx
+import requests
+
+from contextlib import contextmanager
+from openai import OpenAI
+from azure.ai.inference import ChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from config import Config
+
+GITHUB_MODELS_ENDPOINT = "https://models.inference.ai.azure.com"
+OPENAI_ENDPOINT = "https://api.openai.com/v1"
+
+
+class LLMClientPool:
+    """LLM clients created once per endpoint and shared by every request."""
+    def __init__(self, max_connections=None, connect_timeout=None, read_timeout=None):
+        self.max_connections = max_connections or Config.LLM_MAX_CONNECTIONS
+        self.connect_timeout = connect_timeout or Config.LLM_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or Config.LLM_READ_TIMEOUT
+        self._clients = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, factory):
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = factory()
+                    self._clients[key] = client
+        return client
+
+    def openai(self, base_url=GITHUB_MODELS_ENDPOINT):
+        def factory():
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            )
+            return OpenAI(base_url=base_url, api_key=os.environ["GITHUB_TOKEN"],
+                          http_client=http_client, timeout=self.read_timeout)
+        return self._get_or_create(("openai", base_url), factory)
+
+    def azure(self, endpoint=GITHUB_MODELS_ENDPOINT):
+        def factory():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+            session.mount("https://", adapter)
+            transport = RequestsTransport(session=session, session_owner=False,
+                                          connection_timeout=self.connect_timeout,
+                                          read_timeout=self.read_timeout)
+            return ChatCompletionsClient(endpoint=endpoint,
+                                         credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]),
+                                         transport=transport)
+        return self._get_or_create(("azure", endpoint), factory)
+
+    @contextmanager
+    def slot(self, endpoint):
+        semaphore = self._slots.get(endpoint)
+        if semaphore is None:
+            with self._lock:
+                semaphore = self._slots.setdefault(endpoint, threading.BoundedSemaphore(self.max_connections))
+        with semaphore:
+            yield
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+llm_clients = LLMClientPool()
@@ -0,0 +1,78 @@
+import os
+import threading
+
+
+class ModelRegistry:
+    """Loads heavy models once per process, on first use."""
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self._registry_lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def names(self):
+        return list(self._loaders.keys())
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._loaders:
+            raise KeyError(f"No model registered under '{name}'")
+
+        with self._locks[name]:
+            # Another thread may have finished loading while we waited on the lock
+            model = self._models.get(name)
+            if model is None:
+                print(f"loading model '{name}'")
+                model = self._loaders[name]()
+                self._models[name] = model
+        return model
+
+    def warm_up(self, names=None):
+        for name in names or self.names():
+            self.get(name)
+
+    def unload(self, name):
+        with self._locks[name]:
+            self._models.pop(name, None)
+
+    def reload(self, name):
+        with self._locks[name]:
+            self._models.pop(name, None)
+            self._models[name] = self._loaders[name]()
+        return self._models[name]
+
+
+def load_ner_model():
+    import torch
+    from transformers import AutoModelForTokenClassification, AutoTokenizer
+
+    model_dir = os.path.join(os.path.dirname(__file__), "..", "inference_model")
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForTokenClassification.from_pretrained(model_dir)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    model.eval()
+    return {"tokenizer": tokenizer, "model": model, "device": device}
+
+
+def load_sentence_transformer():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('paraphrase-MiniLM-L6-v2')
+
+
+model_registry = ModelRegistry()
+model_registry.register("ner", load_ner_model)
+model_registry.register("sentence_transformer", load_sentence_transformer)
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+from config import Config
+
+
+class OCRCache:
+    """Memory + disk cache of OCR output keyed by the rendered page content."""
+    def __init__(self, cache_dir=None, memory_entries=None, max_disk_bytes=None):
+        self.cache_dir = cache_dir or Config.OCR_CACHE_DIR
+        self.memory_entries = memory_entries if memory_entries is not None else Config.OCR_CACHE_MEMORY_ENTRIES
+        self.max_disk_bytes = max_disk_bytes if max_disk_bytes is not None else Config.OCR_CACHE_MAX_BYTES
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def key(self, image_bytes, settings):
+        digest = hashlib.sha256()
+        digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self.saved_seconds += entry["ocr_seconds"]
+                return entry["text"]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+            self.disk_hits += 1
+            self.saved_seconds += entry["ocr_seconds"]
+        return entry["text"]
+
+    def put(self, key, text, ocr_seconds=0.0):
+        entry = {"text": text, "ocr_seconds": ocr_seconds}
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.max_disk_bytes <= 0:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"OCR cache write failed: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += size
+            over_budget = self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self.evict()
+
+    def _cache_files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _scan_disk_bytes(self):
+        return sum(size for _, size, _ in self._cache_files())
+
+    def evict(self):
+        # Oldest files first (a hit refreshes the mtime), leaving 10% of max_disk_bytes free
+        files = sorted(self._cache_files())
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def counters(self):
+        with self._lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "saved_seconds": self.saved_seconds}
+
+    def merge(self, counters):
+        # Adds lookups made in another process (the page OCR workers) to this process's counters
+        with self._lock:
+            self.memory_hits += counters["memory_hits"]
+            self.disk_hits += counters["disk_hits"]
+            self.misses += counters["misses"]
+            self.saved_seconds += counters["saved_seconds"]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        for _, _, path in self._cache_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "memory_entries": len(self._memory),
+            }
+
+
+ocr_cache = OCRCache()
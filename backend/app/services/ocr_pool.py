@@ -0,0 +1,77 @@
+import threading
+import multiprocessing
+import pytesseract
+
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+
+try:
+    # tesserocr binds the Tesseract C++ API directly, so a worker keeps the engine and
+    # language data loaded between pages instead of spawning `tesseract` per image.
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+class OCRWorkerPool:
+    """Long-lived OCR worker processes that each set up their engine once."""
+    def __init__(self, workers=None, lang=None):
+        self.workers = workers or Config.OCR_POOL_WORKERS
+        self.lang = lang or Config.OCR_LANG
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        return "tesserocr" if tesserocr is not None else "pytesseract"
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    mp_context = multiprocessing.get_context(Config.OCR_START_METHOD) if Config.OCR_START_METHOD else None
+                    if tesserocr is None:
+                        print("WARNING: OCR_BACKEND=pool but tesserocr is not installed; OCR workers fall back to "
+                              "pytesseract, which still starts a tesseract process and writes temp files for every "
+                              "page. Install tesserocr (see requirements.txt and the Dockerfile) or use "
+                              "OCR_BACKEND=pytesseract.")
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context,
+                                                         initializer=_init_engine, initargs=(self.lang,))
+                    print(f"started OCR worker pool ({self.workers} workers, {self.engine})")
+        return self._executor
+
+    def submit(self, image):
+        return self._get_executor().submit(_recognize, image)
+
+    def map(self, images):
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+# Per-worker engine state, created once by the pool initializer
+_engine = None
+_engine_lang = None
+
+def _init_engine(lang):
+    global _engine, _engine_lang
+    _engine_lang = lang
+    if tesserocr is not None:
+        _engine = tesserocr.PyTessBaseAPI(lang=lang)
+
+def _recognize(image):
+    if _engine is None:
+        return pytesseract.image_to_string(image, lang=_engine_lang)
+
+    height, width = image.shape[:2]
+    bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+    _engine.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+    return _engine.GetUTF8Text()
+
+
+ocr_pool = OCRWorkerPool()
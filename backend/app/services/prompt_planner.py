@@ -0,0 +1,105 @@
+import ast
+
+from config import Config
+
+try:
+    # Exact BPE counts when tiktoken is installed; otherwise a ~4 characters per token estimate
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+INDEXED_OUTPUT_INSTRUCTION = (
+    " Each item below is prefixed with its index in square brackets. Return only a Python list of"
+    " [index, result] pairs, one for every index, e.g. [[0, \"...\"], [1, \"...\"]]:\n"
+)
+
+
+class PromptPlanner:
+    """Splits long item lists into prompts that fit a model's input and output limits."""
+    def __init__(self):
+        self._encoding = None
+
+    def count_tokens(self, text):
+        if tiktoken is None:
+            return len(text) // 4 + 1
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("o200k_base")
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def limits(self, model):
+        return Config.MODEL_LIMITS.get(model, Config.MODEL_LIMITS["default"])
+
+    def indexed_prompt(self, prompt):
+        return prompt.rstrip(":\n ") + "." + INDEXED_OUTPUT_INSTRUCTION
+
+    def indexed_items(self, chunk):
+        return [f"[{index}] {item}" for index, item in chunk]
+
+    def output_budget(self, model, chunk, output_per_item):
+        # Completion tokens to request for a chunk: the per-item estimate plus list syntax overhead
+        expected = sum(output_per_item(item) for _, item in chunk) + 8 * len(chunk) + 16
+        return min(self.limits(model)["output"], expected)
+
+    def plan(self, model, prompt, items, output_per_item):
+        """
+        Returns a list of chunks, each a list of (index, item) in the original order.
+        `output_per_item(item)` estimates the completion tokens one item needs.
+        """
+        limits = self.limits(model)
+        prompt_tokens = self.count_tokens(self.indexed_prompt(prompt))
+        chunks = []
+        chunk, chunk_input, chunk_output = [], prompt_tokens, 16
+        for index, item in enumerate(items):
+            # "Q: [index] ...\nA: " framing from FeedbackService.build_request costs a few tokens
+            item_input = self.count_tokens(str(item)) + 8
+            item_output = output_per_item(item) + 8
+            if chunk and (chunk_input + item_input > limits["input"] - chunk_output - item_output
+                          or chunk_output + item_output > limits["output"]
+                          or len(chunk) >= Config.PROMPT_MAX_ITEMS_PER_CHUNK):
+                chunks.append(chunk)
+                chunk, chunk_input, chunk_output = [], prompt_tokens, 16
+            chunk.append((index, item))
+            chunk_input += item_input
+            chunk_output += item_output
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def parse_indexed(self, content, indices):
+        """
+        Parses [[index, result], ...] output; returns {index: result} or None when the output
+        is not such a list or its indices don't match the ones that were sent.
+        """
+        if not content:
+            return None
+        text = content.strip()
+        if text.startswith("```"):
+            text = text.strip("`")
+            text = text[text.find("\n") + 1:] if "\n" in text else text
+        start, end = text.find("["), text.rfind("]")
+        if start == -1 or end <= start:
+            return None
+        try:
+            pairs = ast.literal_eval(text[start:end + 1])
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return None
+        if not isinstance(pairs, (list, tuple)):
+            return None
+
+        parsed = {}
+        for pair in pairs:
+            if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+                return None
+            try:
+                index = int(pair[0])
+            except (TypeError, ValueError):
+                return None
+            if index in parsed:
+                return None
+            parsed[index] = "" if pair[1] is None else str(pair[1])
+        if set(parsed) != set(indices):
+            return None
+        return parsed
+
+
+prompt_planner = PromptPlanner()
@@ -0,0 +1,240 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+from config import Config
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+class UpstreamThrottled(Exception):
+    """Raised when a model keeps answering 429 after every retry, or the queue wait runs out."""
+    pass
+
+
+def is_throttled(error):
+    # openai.RateLimitError and azure HttpResponseError both carry the HTTP status code
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429
+
+
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class TokenBucket:
+    # Refills `rate` units per second up to `capacity`; callers hold the limiter lock
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class ModelLimiter:
+    """Request/token buckets and an AIMD concurrency limit for one model."""
+    def __init__(self, model, rpm, tpm):
+        self.model = model
+        self.requests = TokenBucket(rpm / 60.0, max(1, rpm))
+        self.tokens = TokenBucket(tpm / 60.0, max(1, tpm))
+        self.limit = float(Config.RATE_LIMIT_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.avg_latency = None
+        self.waiters = []
+        self.stats = {"granted": 0, "throttled": 0, "latency_spikes": 0, "rejected": 0}
+
+    def try_grant(self, ticket, tokens, now):
+        """Returns 0 when `ticket` may start (capacity is consumed), else seconds to wait before retrying."""
+        if not self.waiters or self.waiters[0] != ticket:
+            return 0.05
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return 0.05
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        heapq.heappop(self.waiters)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        self.stats["granted"] += 1
+        return 0.0
+
+    def release(self, latency=None, throttled=False, pause=0.0):
+        now = time.monotonic()
+        self.in_flight -= 1
+        spike = latency is not None and self.avg_latency is not None and \
+            latency > self.avg_latency * Config.RATE_LIMIT_LATENCY_FACTOR
+        if throttled or spike:
+            self.stats["throttled" if throttled else "latency_spikes"] += 1
+            if now - self.last_decrease > 1.0:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+            if pause:
+                self.blocked_until = max(self.blocked_until, now + pause)
+        elif latency is not None:
+            self.limit = min(float(Config.RATE_LIMIT_MAX_CONCURRENCY), self.limit + 1.0 / self.limit)
+        if latency is not None and not throttled:
+            self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+
+
+class AdaptiveRateLimiter:
+    """Admission control shared by every upstream LLM call, keyed by model."""
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._sequence = itertools.count()
+
+    def _limiter(self, model):
+        # Called with self._lock held
+        limiter = self._models.get(model)
+        if limiter is None:
+            limits = Config.RATE_LIMITS.get(model, Config.RATE_LIMITS["default"])
+            limiter = self._models[model] = ModelLimiter(model, limits["rpm"], limits["tpm"])
+        return limiter
+
+    def _enqueue(self, model, priority):
+        with self._lock:
+            limiter = self._limiter(model)
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(limiter.waiters, ticket)
+            return limiter, ticket
+
+    def _abandon(self, limiter, ticket):
+        with self._lock:
+            if ticket in limiter.waiters:
+                limiter.waiters.remove(ticket)
+                heapq.heapify(limiter.waiters)
+                limiter.stats["rejected"] += 1
+                self._changed.notify_all()
+
+    def acquire(self, model, tokens=0, priority=PRIORITY_BULK):
+        limiter, ticket = self._enqueue(model, priority)
+        give_up_at = time.monotonic() + Config.RATE_LIMIT_MAX_WAIT
+        try:
+            with self._lock:
+                while True:
+                    now = time.monotonic()
+                    wait = limiter.try_grant(ticket, tokens, now)
+                    if wait == 0:
+                        self._changed.notify_all()
+                        return limiter
+                    if now + wait > give_up_at:
+                        raise UpstreamThrottled(f"{model}: waited {Config.RATE_LIMIT_MAX_WAIT}s for a rate limit slot")
+                    self._changed.wait(timeout=wait)
+        except BaseException:
+            self._abandon(limiter, ticket)
+            raise
+
+    async def acquire_async(self, model, tokens=0, priority=PRIORITY_BULK):
+        limiter, ticket = self._enqueue(model, priority)
+        give_up_at = time.monotonic() + Config.RATE_LIMIT_MAX_WAIT
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = limiter.try_grant(ticket, tokens, now)
+                    if wait == 0:
+                        self._changed.notify_all()
+                        return limiter
+                if now + wait > give_up_at:
+                    raise UpstreamThrottled(f"{model}: waited {Config.RATE_LIMIT_MAX_WAIT}s for a rate limit slot")
+                await asyncio.sleep(min(wait, 0.05))
+        except BaseException:
+            self._abandon(limiter, ticket)
+            raise
+
+    def release(self, limiter, latency=None, throttled=False, pause=0.0):
+        with self._lock:
+            limiter.release(latency, throttled, pause)
+            self._changed.notify_all()
+
+    def _backoff(self, error, attempt):
+        return retry_after(error) or min(30.0, 2.0 ** attempt)
+
+    def call(self, model, fn, tokens=0, priority=PRIORITY_BULK):
+        if not Config.RATE_LIMIT_ENABLED:
+            return fn()
+        for attempt in range(Config.RATE_LIMIT_MAX_RETRIES + 1):
+            limiter = self.acquire(model, tokens, priority)
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_throttled(e):
+                    self.release(limiter)
+                    raise
+                print(f"{model} throttled (attempt {attempt + 1}), backing off")
+                self.release(limiter, throttled=True, pause=self._backoff(e, attempt))
+                continue
+            self.release(limiter, latency=time.monotonic() - start)
+            return result
+        raise UpstreamThrottled(f"{model}: still rate limited after {Config.RATE_LIMIT_MAX_RETRIES} retries")
+
+    async def call_async(self, model, fn, tokens=0, priority=PRIORITY_BULK):
+        if not Config.RATE_LIMIT_ENABLED:
+            return await fn()
+        for attempt in range(Config.RATE_LIMIT_MAX_RETRIES + 1):
+            limiter = await self.acquire_async(model, tokens, priority)
+            start = time.monotonic()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                self.release(limiter)
+                raise
+            except Exception as e:
+                if not is_throttled(e):
+                    self.release(limiter)
+                    raise
+                print(f"{model} throttled (attempt {attempt + 1}), backing off")
+                self.release(limiter, throttled=True, pause=self._backoff(e, attempt))
+                continue
+            self.release(limiter, latency=time.monotonic() - start)
+            return result
+        raise UpstreamThrottled(f"{model}: still rate limited after {Config.RATE_LIMIT_MAX_RETRIES} retries")
+
+    def stats(self):
+        with self._lock:
+            return {
+                model: dict(limiter.stats,
+                            concurrency_limit=round(limiter.limit, 2),
+                            in_flight=limiter.in_flight,
+                            queued=len(limiter.waiters),
+                            avg_latency=round(limiter.avg_latency or 0.0, 3))
+                for model, limiter in self._models.items()
+            }
+
+
+def estimate_tokens(text, max_tokens=0):
+    # Rough prompt size (~4 characters per token) plus the completion budget
+    return len(text) // 4 + max_tokens
+
+
+rate_limiter = AdaptiveRateLimiter()
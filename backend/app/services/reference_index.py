@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import atexit
+import threading
+import numpy as np
+
+from config import Config
+from app.services.embedding_service import embedding_service
+
+
+class ReferenceAnswerIndex:
+    """Persistent vector index of exam questions and their validated consensus answers."""
+    def __init__(self, path=None, threshold=None, max_entries=None):
+        self.path = path or Config.REFERENCE_INDEX_PATH
+        self.threshold = threshold if threshold is not None else Config.REFERENCE_INDEX_THRESHOLD
+        self.max_entries = max_entries or Config.REFERENCE_INDEX_MAX_ENTRIES
+        self._vectors = None
+        self._entries = []
+        self._scopes = np.empty(0, dtype=object)
+        self._loaded = False
+        self._dirty = False
+        self._last_save = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "added": 0}
+        atexit.register(self.flush)
+
+    def _load(self):
+        # Called with self._lock held
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with np.load(self.path + ".npz") as data:
+                vectors = data["vectors"].astype(np.float32)
+            with open(self.path + ".json", "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Reference index at {self.path} unreadable, starting empty: {e}")
+            return
+        if len(entries) != len(vectors):
+            print(f"Reference index at {self.path} is inconsistent, starting empty")
+            return
+        self._vectors, self._entries = vectors, entries
+        self._scopes = self._scope_array(entries)
+
+    @staticmethod
+    def _scope_array(entries):
+        scopes = np.empty(len(entries), dtype=object)
+        scopes[:] = [entry.get("scope") for entry in entries]
+        return scopes
+
+    def _save(self):
+        # Called with self._lock held; write to temp files and swap so readers never see half an index
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        vectors = self._vectors if self._vectors is not None else np.zeros((0, 0), dtype=np.float32)
+        with open(self.path + ".tmp.npz", "wb") as f:
+            np.savez(f, vectors=vectors)
+        with open(self.path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(self.path + ".tmp.npz", self.path + ".npz")
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+        self._dirty = False
+        self._last_save = time.time()
+
+    def _search(self, query_vectors, k=1, scope=None):
+        # Called with self._lock held, so the returned indices refer to the current entries
+        query_vectors = np.atleast_2d(query_vectors)
+        vectors = self._vectors
+        if vectors is None or not len(vectors) or vectors.shape[1] != query_vectors.shape[1]:
+            empty = np.zeros((len(query_vectors), 0))
+            return empty.astype(int), empty
+        scores = query_vectors @ vectors.T
+        scores[:, self._scopes != scope] = -np.inf
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def search(self, query_vectors, k=1, scope=None):
+        """Top-k (indices, scores) of the indexed questions in `scope` for each query vector, best first."""
+        with self._lock:
+            self._load()
+            return self._search(query_vectors, k, scope)
+
+    def lookup(self, questions, scope=None, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        if not questions:
+            return []
+        query_vectors = embedding_service.encode_many(questions)
+        answers = []
+        with self._lock:
+            self._load()
+            indices, scores = self._search(query_vectors, 1, scope)
+            for row, question in enumerate(questions):
+                if indices.shape[1] and scores[row, 0] >= threshold:
+                    entry = self._entries[indices[row, 0]]
+                    entry["hits"] = entry.get("hits", 0) + 1
+                    answers.append(entry["answer"])
+                    self._stats["hits"] += 1
+                else:
+                    answers.append(None)
+                    self._stats["misses"] += 1
+        return answers
+
+    def add(self, questions, answers, source=None, scope=None):
+        pairs = [(q, a) for q, a in zip(questions, answers) if q and q.strip() and a and a.strip()]
+        if not pairs:
+            return 0
+        vectors = embedding_service.encode_many([q for q, _ in pairs]).astype(np.float32)
+
+        with self._lock:
+            self._load()
+            _, scores = self._search(vectors, 1, scope)
+            new_vectors, new_entries = [], []
+            for row, (question, answer) in enumerate(pairs):
+                if scores.shape[1] and scores[row, 0] >= self.threshold:
+                    continue
+                # Also skip near-duplicates within this batch
+                if new_vectors and max(float(vectors[row] @ v) for v in new_vectors) >= self.threshold:
+                    continue
+                new_vectors.append(vectors[row])
+                new_entries.append({"question": question, "answer": answer, "source": source, "scope": scope,
+                                    "hits": 0, "created_at": time.time()})
+            if not new_entries:
+                return 0
+
+            stacked = np.vstack(new_vectors)
+            if self._vectors is None or self._vectors.shape[1] != stacked.shape[1]:
+                # First entries, or the embedding model changed: old vectors are not comparable
+                self._vectors, self._entries = stacked, new_entries
+            else:
+                self._vectors = np.vstack([self._vectors, stacked])
+                self._entries.extend(new_entries)
+            if len(self._entries) > self.max_entries:
+                # Keep the most reused answers, newest first among equals
+                keep = sorted(range(len(self._entries)),
+                              key=lambda i: (self._entries[i].get("hits", 0), self._entries[i]["created_at"]),
+                              reverse=True)[:self.max_entries]
+                keep.sort()
+                self._vectors = self._vectors[keep]
+                self._entries = [self._entries[i] for i in keep]
+            self._scopes = self._scope_array(self._entries)
+            self._stats["added"] += len(new_entries)
+            self._dirty = True
+            if time.time() - self._last_save >= Config.REFERENCE_INDEX_SAVE_INTERVAL:
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"Reference index save failed: {e}")
+        return len(new_entries)
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"Reference index save failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._loaded = True
+            self._vectors, self._entries = None, []
+            self._scopes = self._scope_array(self._entries)
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats,
+                        size=len(self._entries),
+                        hit_rate=self._stats["hits"] / lookups if lookups else 0.0)
+
+
+reference_index = ReferenceAnswerIndex()
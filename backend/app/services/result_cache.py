@@ -0,0 +1,111 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from app.services import sqlite_db
+from config import Config
+
+
+class GradingResultCache:
+    """SQLite cache of grading results per document and model."""
+    def __init__(self, db_path=None, ttl=None):
+        self.db_path = db_path or Config.RESULT_CACHE_PATH
+        self.ttl = ttl if ttl is not None else Config.RESULT_CACHE_TTL
+        self._db = None
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._stats = {"hits": 0, "misses": 0, "joined": 0}
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _connection(self):
+        # Called with self._lock held
+        if self._db is None:
+            self._db = sqlite_db.connect(
+                self.db_path,
+                "CREATE TABLE IF NOT EXISTS grading_results ("
+                " digest TEXT, model TEXT, result TEXT, created_at REAL,"
+                " PRIMARY KEY (digest, model))",
+            )
+        return self._db
+
+    def _lookup(self, digest, model):
+        # Called with self._lock held
+        try:
+            row = self._connection().execute(
+                "SELECT result, created_at FROM grading_results WHERE digest = ? AND model = ?",
+                (digest, model)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Result cache read failed: {e}")
+            return None
+        if row is None or (self.ttl > 0 and time.time() - row[1] > self.ttl):
+            return None
+        return json.loads(row[0])
+
+    def get(self, digest, model):
+        with self._lock:
+            result = self._lookup(digest, model)
+            self._stats["hits" if result is not None else "misses"] += 1
+            return result
+
+    def put(self, digest, model, result):
+        with self._lock:
+            try:
+                db = self._connection()
+                db.execute("INSERT OR REPLACE INTO grading_results (digest, model, result, created_at) VALUES (?, ?, ?, ?)",
+                           (digest, model, json.dumps(result, default=str), time.time()))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Result cache write failed: {e}")
+
+    def start_or_join(self, digest, model, start, is_running):
+        """Returns (cached_result, None) on a hit, otherwise (None, job_id) of the running or new job."""
+        key = (digest, model)
+        with self._lock:
+            result = self._lookup(digest, model)
+            if result is not None:
+                self._stats["hits"] += 1
+                return result, None
+            job_id = self._inflight.get(key)
+            if job_id is not None and is_running(job_id):
+                self._stats["joined"] += 1
+                return None, job_id
+            job_id = start()
+            self._inflight[key] = job_id
+            return None, job_id
+
+    def finish(self, digest, model, result=None):
+        # Called by the grading job when it ends; stores the result first so no upload falls in between
+        if result is not None:
+            self.put(digest, model, result)
+        with self._lock:
+            self._inflight.pop((digest, model), None)
+
+    def invalidate(self, digest, model=None):
+        with self._lock:
+            try:
+                db = self._connection()
+                if model is None:
+                    removed = db.execute("DELETE FROM grading_results WHERE digest = ?", (digest,)).rowcount
+                else:
+                    removed = db.execute("DELETE FROM grading_results WHERE digest = ? AND model = ?",
+                                         (digest, model)).rowcount
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Result cache invalidation failed: {e}")
+                return 0
+            return removed
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats,
+                        in_flight=len(self._inflight),
+                        hit_rate=self._stats["hits"] / lookups if lookups else 0.0)
+
+
+grading_results = GradingResultCache()
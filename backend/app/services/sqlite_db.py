@@ -0,0 +1,15 @@
+import os
+import sqlite3
+
+
+def connect(db_path, *schema):
+    # One WAL-mode connection per cache object, shared by its threads under the cache's own lock
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        db.execute(statement)
+    db.commit()
+    return db
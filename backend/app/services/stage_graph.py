@@ -0,0 +1,76 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import Config
+
+
+class StageGraph:
+    """Runs pipeline stages on a thread pool as soon as their dependencies finish."""
+    def __init__(self):
+        self.stages = {}
+        self.timings = {}
+        self.wall_time = 0.0
+
+    def add(self, name, fn, deps=()):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on undeclared stage '{dep}'")
+        self.stages[name] = (fn, tuple(deps))
+        return self
+
+    def run(self, max_workers=None, on_stage_done=None):
+        max_workers = max_workers or Config.PIPELINE_STAGE_WORKERS
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        run_start = time.perf_counter()
+
+        def timed(name, fn, kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(**kwargs)
+            finally:
+                end = time.perf_counter()
+                self.timings[name] = {
+                    "start": round(start - run_start, 3),
+                    "end": round(end - run_start, 3),
+                    "duration": round(end - start, 3),
+                }
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+            try:
+                while pending or running:
+                    for name, (fn, deps) in list(pending.items()):
+                        if all(dep in results for dep in deps):
+                            kwargs = {dep: results[dep] for dep in deps}
+                            running[executor.submit(timed, name, fn, kwargs)] = name
+                            del pending[name]
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        results[name] = future.result()
+                        if on_stage_done is not None:
+                            on_stage_done(name, results[name])
+            except Exception:
+                for future in running:
+                    future.cancel()
+                raise
+
+        self.wall_time = round(time.perf_counter() - run_start, 3)
+        return results
+
+    def critical_path(self):
+        # Longest chain of stage durations through the dependency graph (stages are declared in order)
+        longest = {}
+        for name, (_, deps) in self.stages.items():
+            duration = self.timings.get(name, {}).get("duration", 0.0)
+            best_dep = max(deps, key=lambda dep: longest[dep][0], default=None)
+            if best_dep is None:
+                longest[name] = (duration, [name])
+            else:
+                longest[name] = (longest[best_dep][0] + duration, longest[best_dep][1] + [name])
+        if not longest:
+            return 0.0, []
+        total, path = max(longest.values(), key=lambda item: item[0])
+        return round(total, 3), path
@@ -0,0 +1,188 @@
+import io
+import os
+import time
+import threading
+import boto3
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+
+class Configurable:
+    # Settings come from Config, or from the Flask app config once `configure(app.config)` is called
+    _settings = None
+
+    def setting(self, name, default=None):
+        value = self._settings.get(name) if self._settings else None
+        return value if value is not None else getattr(Config, name, default)
+
+
+class StorageService(Configurable):
+    """S3 uploads through one pooled client per process."""
+    def __init__(self, settings=None):
+        self._settings = settings or {}
+        self._client = None
+        self._client_pid = None
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.stats = {"uploaded": 0, "skipped": 0, "retried": 0, "failed": 0, "bytes": 0}
+        # Most recent background upload failures, for /cache-stats
+        self.failures = deque(maxlen=100)
+
+    def configure(self, settings):
+        with self._lock:
+            self._settings = settings
+            self._client = None
+
+    @property
+    def bucket(self):
+        return self.setting("AWS_S3_BUCKET_NAME")
+
+    def client(self):
+        with self._lock:
+            if self._client is None or self._client_pid != os.getpid():
+                access_key = self.setting("AWS_ACCESS_KEY_ID")
+                secret_key = self.setting("AWS_SECRET_ACCESS_KEY")
+                if not self.bucket or not access_key or not secret_key:
+                    raise Exception("AWS S3 configuration is incomplete.")
+                self._client = boto3.client(
+                    "s3",
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    region_name=self.setting("AWS_DEFAULT_REGION", "us-east-2"),
+                    endpoint_url=self.setting("S3_ENDPOINT_URL") or None,
+                    config=BotoConfig(max_pool_connections=self.setting("S3_MAX_POOL_CONNECTIONS"),
+                                      retries={"max_attempts": 5, "mode": "adaptive"}),
+                )
+                self._client_pid = os.getpid()
+                print("S3 client initialized")
+            return self._client
+
+    def transfer_config(self):
+        return TransferConfig(
+            multipart_threshold=self.setting("S3_MULTIPART_THRESHOLD"),
+            multipart_chunksize=self.setting("S3_MULTIPART_CHUNKSIZE"),
+            max_concurrency=self.setting("S3_MAX_CONCURRENCY"),
+            use_threads=True,
+        )
+
+    def object_url(self, object_name):
+        endpoint_url = self.setting("S3_ENDPOINT_URL")
+        if endpoint_url:
+            return f"{endpoint_url.rstrip('/')}/{self.bucket}/{object_name}"
+        return f"https://{self.bucket}.s3.{self.setting('AWS_DEFAULT_REGION', 'us-east-2')}.amazonaws.com/{object_name}"
+
+    def upload(self, fileobj, object_name, content_type="application/octet-stream", metadata=None, record_failure=True):
+        fileobj.seek(0, io.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        extra_args = {
+            "ContentType": content_type,
+            "ContentDisposition": "inline",
+        }
+        if metadata:
+            extra_args["Metadata"] = metadata
+        try:
+            self.client().upload_fileobj(
+                fileobj,
+                self.bucket,
+                object_name,
+                ExtraArgs=extra_args,
+                Config=self.transfer_config(),
+            )
+        except Exception:
+            if record_failure:
+                with self._lock:
+                    self.stats["failed"] += 1
+            raise
+        with self._lock:
+            self.stats["uploaded"] += 1
+            self.stats["bytes"] += size
+        return self.object_url(object_name)
+
+    def head(self, object_name):
+        # Object metadata, or None when the object does not exist
+        try:
+            return self.client().head_object(Bucket=self.bucket, Key=object_name)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def upload_in_background(self, data, object_name, content_type="application/octet-stream", on_error=None,
+                             skip_existing=False, metadata=None, on_done=None):
+        """
+        Queues `data` for upload and returns (url, future) at once; failures are retried, then passed to `on_error`.
+        `on_done(uploaded)` is called after success, with False when `skip_existing` found the object already there.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.setting("S3_UPLOAD_WORKERS"),
+                                                    thread_name_prefix="s3-upload")
+            executor = self._executor
+
+        def run():
+            retries = self.setting("S3_UPLOAD_RETRIES", 0)
+            for attempt in range(retries + 1):
+                try:
+                    uploaded = not (skip_existing and self.head(object_name) is not None)
+                    if uploaded:
+                        url = self.upload(io.BytesIO(data), object_name, content_type, metadata=metadata,
+                                          record_failure=False)
+                    else:
+                        with self._lock:
+                            self.stats["skipped"] += 1
+                        url = self.object_url(object_name)
+                except Exception as e:
+                    if attempt < retries:
+                        print(f"Background upload of {object_name} failed ({e}), retrying")
+                        with self._lock:
+                            self.stats["retried"] += 1
+                        time.sleep(self.setting("S3_UPLOAD_RETRY_BACKOFF", 0.5) * 2 ** attempt)
+                        continue
+                    print(f"Background upload of {object_name} failed: {e}")
+                    with self._lock:
+                        self.stats["failed"] += 1
+                        self.failures.append({"object_name": object_name, "error": str(e), "time": time.time()})
+                    if on_error is not None:
+                        on_error(e)
+                    raise
+                if on_done is not None:
+                    on_done(uploaded)
+                return url
+
+        future = executor.submit(run)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return self.object_url(object_name), future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def flush(self, timeout=None):
+        # Waits for queued background uploads (used on shutdown and in tests)
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending), recent_failures=list(self.failures)[-10:])
+
+
+storage_service = StorageService()
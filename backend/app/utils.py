@@ -1,9 +1,9 @@
 from wtforms import ValidationError
 import re
 from app.models import User
-import boto3
 import mimetypes
 from botocore.exceptions import NoCredentialsError
+from app.services.blob_storage import blob_storage
 
 def password_complexity(form, field):
     password = field.data
@@ -21,47 +21,23 @@ def validate_email_unique(form, field):
     if user:
         raise ValidationError("This email is already in use.")
 
-def upload_to_s3(file, user_id, folder, app):
+def store_upload(file, background=False):
+    """Stores the upload in blob storage and returns its absolute URL."""
     debug_logs = []
 
     try:
-        bucket_name = app.config.get("AWS_S3_BUCKET_NAME")
-        aws_access_key_id = app.config.get("AWS_ACCESS_KEY_ID")
-        aws_secret_access_key = app.config.get("AWS_SECRET_ACCESS_KEY")
-        aws_region = app.config.get("AWS_DEFAULT_REGION", "us-east-2")  
-        if not bucket_name or not aws_access_key_id or not aws_secret_access_key:
-            debug_logs.append("AWS S3 configuration is incomplete.")
-            raise Exception("AWS S3 configuration is incomplete.")
-
-        debug_logs.append(f"Bucket name: {bucket_name}")
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name=aws_region,
-        )
-        debug_logs.append("S3 client initialized successfully.")
-
-        object_name = f"{folder}/{user_id}/{file.filename}"
-        debug_logs.append(f"Object name: {object_name}")
-
         # Guess the file content type
         content_type, _ = mimetypes.guess_type(file.filename)
         if not content_type:
             content_type = "application/octet-stream"
 
-        file.seek(0)  
-        s3.upload_fileobj(
-            file,
-            bucket_name,
-            object_name,
-            ExtraArgs={
-                "ContentType": content_type,
-                "ContentDisposition": "inline",
-            },
-        )
-        debug_logs.append("File uploaded successfully.")
-        file_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{object_name}"
+        file.seek(0)
+        if background:
+            digest = blob_storage.put_bytes(file.read(), file.filename, content_type, background=True)
+        else:
+            digest = blob_storage.put(file.stream, file.filename, content_type)
+        file_url = blob_storage.url(digest)
+        debug_logs.append(f"Stored {file.filename} as blob {digest} ({blob_storage.backend.name})")
         debug_logs.append(f"File URL: {file_url}")
         return file_url
 
@@ -69,7 +45,7 @@ def upload_to_s3(file, user_id, folder, app):
         debug_logs.append("AWS credentials not available.")
         raise Exception("AWS credentials not available.")
     except Exception as e:
-        debug_logs.append(f"Error uploading file to S3: {str(e)}")
-        raise Exception(f"Error uploading file to S3: {str(e)}")
+        debug_logs.append(f"Error storing file: {str(e)}")
+        raise Exception(f"Error storing file: {str(e)}")
     finally:
         print("\n".join(debug_logs))
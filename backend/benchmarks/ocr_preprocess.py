@@ -0,0 +1,77 @@
+"""
+Per-page time and memory of the legacy and fast OCR preprocessing paths.
+
+Usage (from backend/):
+    python -m benchmarks.ocr_preprocess [pdf] [--dpi 150] [--repeat 5] [--ocr]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+import cv2
+import fitz
+import numpy as np
+import pytesseract
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from app.services.data_extraction import DataExtraction
+from config import Config
+
+DEFAULT_PDF = os.path.join(os.path.dirname(__file__), "..", "app", "services", "synthetic_doc_1.pdf")
+
+
+def legacy_preprocess(extractor, page, dpi):
+    pixmap = page.get_pixmap(dpi=dpi)
+    image = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
+    cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    return Image.fromarray(extractor.preprocess_with_cv2(cv_image)), pixmap.stride * pixmap.height
+
+
+def fast_preprocess(extractor, page, dpi):
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    if Config.OCR_CACHE_ENABLED:
+        extractor.ocr_cache_key(pixmap)
+    return extractor.binarize_pixmap(pixmap), pixmap.stride * pixmap.height
+
+
+def measure(fn, repeat, run_ocr):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image, _ = fn()
+        if run_ocr:
+            pytesseract.image_to_string(image)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    _, pixmap_bytes = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), pixmap_bytes + peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf", nargs="?", default=DEFAULT_PDF)
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--ocr", action="store_true", help="include tesseract in the timings")
+    args = parser.parse_args()
+
+    extractor = DataExtraction()
+    document = fitz.open(args.pdf)
+    print(f"{args.pdf} @ {args.dpi} dpi, best of {args.repeat}")
+    print(f"{'page':>4} {'legacy ms':>10} {'fast ms':>9} {'legacy MB':>10} {'fast MB':>8}")
+    for page_number in range(len(document)):
+        page = document[page_number]
+        legacy_time, legacy_peak = measure(lambda: legacy_preprocess(extractor, page, args.dpi), args.repeat, args.ocr)
+        fast_time, fast_peak = measure(lambda: fast_preprocess(extractor, page, args.dpi), args.repeat, args.ocr)
+        print(f"{page_number:>4} {legacy_time * 1000:>10.1f} {fast_time * 1000:>9.1f} "
+              f"{legacy_peak / 2**20:>10.2f} {fast_peak / 2**20:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 
 class Config:
@@ -17,3 +18,138 @@ class Config:
     SESSION_COOKIE_SECURE = False
     SESSION_COOKIE_SAMESITE = "Lax"
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
+
+    # Load the NER / embedding models at startup instead of on the first request
+    WARM_MODELS_ON_STARTUP = os.environ.get("WARM_MODELS_ON_STARTUP", "false").lower() == "true"
+    WARM_MODELS = ["ner", "sentence_transformer"]
+
+    # Number of sentence embeddings kept in the in-process LRU
+    EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 4096))
+
+    # Sliding-window NER: window length / overlap in tokens and windows per forward pass
+    NER_MAX_LENGTH = int(os.environ.get("NER_MAX_LENGTH", 512))
+    NER_STRIDE = int(os.environ.get("NER_STRIDE", 128))
+    NER_BATCH_SIZE = int(os.environ.get("NER_BATCH_SIZE", 16))
+
+    # Long-lived process pool for per-page render + OCR, shared by every document (1 = sequential); start method defaults to the platform's
+    OCR_WORKERS = int(os.environ.get("OCR_WORKERS", os.cpu_count() or 1))
+    OCR_START_METHOD = os.environ.get("OCR_START_METHOD") or None
+
+    # Use a page's embedded text instead of OCR when it has at least this many characters
+    # and no embedded image covers more than this fraction of the page
+    TEXT_LAYER_MIN_CHARS = int(os.environ.get("TEXT_LAYER_MIN_CHARS", 40))
+    TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.environ.get("TEXT_LAYER_MAX_IMAGE_COVERAGE", 0.25))
+
+    # Max pages buffered between stages of the streaming OCR -> NER pipeline, and max pages packed into one NER call
+    PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 2))
+    NER_PAGE_BATCH = int(os.environ.get("NER_PAGE_BATCH", 8))
+
+    # Content-hash OCR cache: in-memory LRU entries plus an on-disk tier evicted by total size
+    OCR_CACHE_ENABLED = os.environ.get("OCR_CACHE_ENABLED", "true").lower() == "true"
+    OCR_CACHE_DIR = os.environ.get("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "studybuddy_ocr_cache"))
+    OCR_CACHE_MEMORY_ENTRIES = int(os.environ.get("OCR_CACHE_MEMORY_ENTRIES", 256))
+    OCR_CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+    # Resolution pages are rasterized at for OCR (72 matches PyMuPDF's default get_pixmap())
+    OCR_DPI = int(os.environ.get("OCR_DPI", 72))
+
+    # OCR engine: "pytesseract" (a tesseract subprocess per page) or "pool" (long-lived OCR worker processes)
+    OCR_BACKEND = os.environ.get("OCR_BACKEND", "pytesseract")
+    OCR_POOL_WORKERS = int(os.environ.get("OCR_POOL_WORKERS", os.cpu_count() or 1))
+    OCR_LANG = os.environ.get("OCR_LANG", "eng")
+
+    # Background grading jobs: worker threads and how long finished results are kept (seconds)
+    GRADING_WORKERS = int(os.environ.get("GRADING_WORKERS", 2))
+    JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 3600))
+
+    # LLM response cache: in-memory LRU in front of a SQLite table with TTL and size-based eviction
+    LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true"
+    LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "studybuddy_llm_cache.sqlite3"))
+    LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", 512))
+    LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+    LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+    # Shared LLM HTTP clients: max concurrent connections per endpoint and timeouts (seconds)
+    LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 8))
+    LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))
+    LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 120))
+
+    # Threads available to independent stages of the feedback pipeline
+    PIPELINE_STAGE_WORKERS = int(os.environ.get("PIPELINE_STAGE_WORKERS", 4))
+
+    # Batched topic extraction: questions per LLM call and concurrent calls
+    TOPIC_BATCH_SIZE = int(os.environ.get("TOPIC_BATCH_SIZE", 10))
+    TOPIC_CONCURRENCY = int(os.environ.get("TOPIC_CONCURRENCY", 3))
+
+    # Multi-model answers: stop once two models agree, hedge providers slower than their deadline (seconds)
+    CONSENSUS_EARLY_EXIT = os.environ.get("CONSENSUS_EARLY_EXIT", "true").lower() == "true"
+    LLM_DEADLINES = {"gpt-4o": 20, "llama": 25, "mistral": 25}
+    LLM_MAX_HEDGES = int(os.environ.get("LLM_MAX_HEDGES", 1))
+    LLM_HARD_TIMEOUT = float(os.environ.get("LLM_HARD_TIMEOUT", 90))
+
+    # Async LLM fan-out: concurrent in-flight requests allowed per model on the shared event loop
+    LLM_ASYNC_CONCURRENCY = int(os.environ.get("LLM_ASYNC_CONCURRENCY", 32))
+
+    # Upstream rate limiting: per-model request/token budgets (per minute), AIMD concurrency and retries on 429
+    RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    RATE_LIMITS = {
+        "default": {"rpm": int(os.environ.get("RATE_LIMIT_RPM", 15)), "tpm": int(os.environ.get("RATE_LIMIT_TPM", 60000))},
+        "gpt-4o-mini": {"rpm": 60, "tpm": 200000},
+    }
+    RATE_LIMIT_INITIAL_CONCURRENCY = int(os.environ.get("RATE_LIMIT_INITIAL_CONCURRENCY", 4))
+    RATE_LIMIT_MAX_CONCURRENCY = int(os.environ.get("RATE_LIMIT_MAX_CONCURRENCY", 16))
+    RATE_LIMIT_LATENCY_FACTOR = float(os.environ.get("RATE_LIMIT_LATENCY_FACTOR", 3.0))
+    RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", 3))
+    RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 120))
+
+    # Prompt planning: per-model token limits used to split long exams into chunks, retries for unparseable chunks,
+    # and how many chunks of one list are sent at a time
+    MODEL_LIMITS = {
+        "default": {"input": 8000, "output": 4000},
+        "gpt-4o": {"input": 8000, "output": 4000},
+        "Llama-3.3-70B-Instruct": {"input": 8000, "output": 4000},
+        "Mistral-Large-2411": {"input": 8000, "output": 4000},
+    }
+    PROMPT_MAX_ITEMS_PER_CHUNK = int(os.environ.get("PROMPT_MAX_ITEMS_PER_CHUNK", 15))
+    PROMPT_CHUNK_RETRIES = int(os.environ.get("PROMPT_CHUNK_RETRIES", 2))
+    PROMPT_CHUNK_CONCURRENCY = int(os.environ.get("PROMPT_CHUNK_CONCURRENCY", 4))
+    ANSWER_TOKENS_PER_QUESTION = int(os.environ.get("ANSWER_TOKENS_PER_QUESTION", 260))
+
+    # Whole-document grading results keyed by sha256(PDF) + model choice
+    RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "studybuddy_results.sqlite3"))
+    RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 30 * 24 * 3600))
+
+    # Reference-answer index: questions within REFERENCE_INDEX_THRESHOLD cosine of an indexed one reuse its answer
+    REFERENCE_INDEX_ENABLED = os.environ.get("REFERENCE_INDEX_ENABLED", "true").lower() == "true"
+    REFERENCE_INDEX_PATH = os.environ.get("REFERENCE_INDEX_PATH", os.path.join(tempfile.gettempdir(), "studybuddy_reference_index"))
+    REFERENCE_INDEX_THRESHOLD = float(os.environ.get("REFERENCE_INDEX_THRESHOLD", 0.92))
+    REFERENCE_INDEX_MAX_ENTRIES = int(os.environ.get("REFERENCE_INDEX_MAX_ENTRIES", 50000))
+    REFERENCE_INDEX_SAVE_INTERVAL = int(os.environ.get("REFERENCE_INDEX_SAVE_INTERVAL", 30))
+
+    # Batch grading: documents per batch, concurrent extractions and per-student feedback calls, per-document and total size caps
+    BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 200))
+    BATCH_EXTRACTION_WORKERS = int(os.environ.get("BATCH_EXTRACTION_WORKERS", 4))
+    BATCH_FEEDBACK_WORKERS = int(os.environ.get("BATCH_FEEDBACK_WORKERS", 8))
+    BATCH_MAX_FILE_BYTES = int(os.environ.get("BATCH_MAX_FILE_BYTES", 25 * 1024 * 1024))
+    BATCH_MAX_TOTAL_BYTES = int(os.environ.get("BATCH_MAX_TOTAL_BYTES", 500 * 1024 * 1024))
+    # Largest request body Flask accepts (413 above it); fits a full batch upload
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", 512 * 1024 * 1024))
+
+    # S3 uploads: local stand-in endpoint, connection pool, multipart transfer settings and background upload threads
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "")
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 20))
+    S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+    S3_MULTIPART_CHUNKSIZE = int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024))
+    S3_MAX_CONCURRENCY = int(os.environ.get("S3_MAX_CONCURRENCY", 8))
+    S3_UPLOAD_WORKERS = int(os.environ.get("S3_UPLOAD_WORKERS", 4))
+    S3_BACKGROUND_UPLOADS = os.environ.get("S3_BACKGROUND_UPLOADS", "true").lower() == "true"
+    S3_UPLOAD_RETRIES = int(os.environ.get("S3_UPLOAD_RETRIES", 3))
+    S3_UPLOAD_RETRY_BACKOFF = float(os.environ.get("S3_UPLOAD_RETRY_BACKOFF", 0.5))
+    # Blob storage for documents and profile pictures: "s3" or "local" (content-addressed files under BLOB_LOCAL_ROOT)
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+    BLOB_LOCAL_ROOT = os.environ.get("BLOB_LOCAL_ROOT", os.path.join(tempfile.gettempdir(), "studybuddy_blobs"))
+    BLOB_S3_PREFIX = os.environ.get("BLOB_S3_PREFIX", "blobs")
+    BLOB_SPOOL_MAX_MEMORY = int(os.environ.get("BLOB_SPOOL_MAX_MEMORY", 8 * 1024 * 1024))
+    # Origin the frontend reaches this API on; local blob URLs are built from it
+    BLOB_PUBLIC_BASE_URL = os.environ.get("BLOB_PUBLIC_BASE_URL", "http://127.0.0.1:5000")
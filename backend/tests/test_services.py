@@ -0,0 +1,354 @@
+import io
+import os
+import sys
+import socket
+import threading
+import time
+
+import boto3
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from app.services.storage_service import StorageService
+from app.services.blob_storage import BlobStorage, S3BlobStore
+from app.services.stage_graph import StageGraph
+from app.services.prompt_planner import PromptPlanner
+from app.services.rate_limiter import AdaptiveRateLimiter, TokenBucket, UpstreamThrottled, PRIORITY_BULK, PRIORITY_INTERACTIVE
+from app.services import async_llm as async_llm_module
+from config import Config
+from app.services.feedback_route import FeedbackService, CONSENSUS_4O, CONSENSUS_LLAMA, CONSENSUS_COMBINE
+
+BUCKET = "studybuddy-test"
+MB = 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    # A local S3 stand-in the storage service reaches through S3_ENDPOINT_URL, like MinIO in development
+    moto_server = pytest.importorskip("moto.server")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+    boto3.client("s3", endpoint_url=endpoint_url, aws_access_key_id="test", aws_secret_access_key="test",
+                 region_name="us-east-1").create_bucket(Bucket=BUCKET)
+    yield endpoint_url
+    server.stop()
+
+
+@pytest.fixture
+def settings(s3_endpoint):
+    return {
+        "AWS_S3_BUCKET_NAME": BUCKET,
+        "AWS_ACCESS_KEY_ID": "test",
+        "AWS_SECRET_ACCESS_KEY": "test",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "S3_ENDPOINT_URL": s3_endpoint,
+        "S3_MULTIPART_THRESHOLD": 5 * MB,
+        "S3_MULTIPART_CHUNKSIZE": 5 * MB,
+        "S3_UPLOAD_RETRIES": 1,
+        "S3_UPLOAD_RETRY_BACKOFF": 0,
+    }
+
+
+@pytest.fixture
+def storage(settings):
+    service = StorageService(settings)
+    yield service
+    service.flush()
+
+
+def test_large_upload_goes_up_in_parts(storage):
+    data = os.urandom(11 * MB)
+    url = storage.upload(io.BytesIO(data), "documents/large.pdf", "application/pdf")
+
+    head = storage.head("documents/large.pdf")
+    assert url == storage.object_url("documents/large.pdf")
+    assert head["ContentLength"] == len(data)
+    assert head["ContentType"] == "application/pdf"
+    # Multipart uploads get an ETag of the form "<md5 of part md5s>-<part count>"
+    assert head["ETag"].strip('"').endswith("-3")
+    assert storage.stats["uploaded"] == 1 and storage.stats["bytes"] == len(data)
+
+
+def test_small_upload_is_a_single_put(storage):
+    storage.upload(io.BytesIO(b"%PDF-1.4 small"), "documents/small.pdf", "application/pdf")
+    assert "-" not in storage.head("documents/small.pdf")["ETag"]
+
+
+def test_background_upload_returns_url_before_upload_finishes(storage):
+    data = os.urandom(64 * 1024)
+    url, future = storage.upload_in_background(data, "profilepictures/1/me.png", "image/png")
+
+    assert url == storage.object_url("profilepictures/1/me.png")
+    future.result(timeout=30)
+    body = storage.client().get_object(Bucket=BUCKET, Key="profilepictures/1/me.png")["Body"].read()
+    assert body == data
+    assert storage.pending() == 0
+
+
+def test_background_upload_skips_existing_objects(storage):
+    storage.upload(io.BytesIO(b"same bytes"), "blobs/existing", "application/octet-stream")
+    _, future = storage.upload_in_background(b"same bytes", "blobs/existing", skip_existing=True)
+    future.result(timeout=30)
+    assert storage.stats["skipped"] == 1
+    assert storage.stats["uploaded"] == 1
+
+
+def test_failed_background_upload_is_retried_and_recorded(storage, settings):
+    storage.configure(dict(settings, AWS_S3_BUCKET_NAME="missing-bucket"))
+    errors = []
+    _, future = storage.upload_in_background(b"data", "documents/lost.pdf", on_error=errors.append)
+    with pytest.raises(Exception):
+        future.result(timeout=30)
+
+    assert len(errors) == 1
+    assert storage.stats["retried"] == 1 and storage.stats["failed"] == 1
+    assert storage.summary()["recent_failures"][0]["object_name"] == "documents/lost.pdf"
+
+
+def test_background_blob_keeps_filename_and_counts_duplicates(storage):
+    blobs = BlobStorage({"STORAGE_BACKEND": "s3"})
+    blobs._backend = S3BlobStore(storage=storage, prefix="blobs")
+    data = os.urandom(1024)
+    digest = blobs.put_bytes(data, "Exam 1.pdf", "application/pdf", background=True)
+    storage.flush()
+    assert blobs.put_bytes(data, "copy.pdf", "application/pdf", background=True) == digest
+    storage.flush()
+
+    assert blobs.stat(digest) == {"size": len(data), "content_type": "application/pdf", "filename": "Exam 1.pdf"}
+    assert blobs.stats["queued"] == 2
+    assert blobs.stats["stored"] == 1 and blobs.stats["deduplicated"] == 1
+    assert blobs.stats["bytes_deduplicated"] == len(data)
+
+
+def per_question_choice(sim_4o_llama, sim_4o_mistral, sim_llama_mistral, threshold_sim):
+    # The if/elif pair selection consensus_choices replaced
+    if sim_4o_llama >= threshold_sim and sim_4o_llama > sim_4o_mistral and sim_4o_llama > sim_llama_mistral:
+        return CONSENSUS_4O
+    elif sim_4o_mistral >= threshold_sim and sim_4o_mistral > sim_4o_llama and sim_4o_mistral > sim_llama_mistral:
+        return CONSENSUS_4O
+    elif sim_llama_mistral >= threshold_sim and sim_llama_mistral > sim_4o_llama and sim_llama_mistral > sim_4o_mistral:
+        return CONSENSUS_LLAMA
+    return CONSENSUS_COMBINE
+
+
+@pytest.mark.parametrize("threshold_sim", [0.0, 0.5, 0.75])
+def test_consensus_choices_match_per_question_logic(threshold_sim):
+    # Small integer vectors, so equal pair similarities (ties) come up often
+    rng = np.random.default_rng(0)
+    emb_4o, emb_llama, emb_mistral = (rng.integers(-1, 2, size=(500, 3)).astype(np.float32) for _ in range(3))
+    choices, pair_sims = FeedbackService().consensus_choices(emb_4o, emb_llama, emb_mistral, threshold_sim)
+
+    expected = [per_question_choice(*row, threshold_sim) for row in pair_sims]
+    assert choices.tolist() == expected
+    assert np.sum(np.all(pair_sims == pair_sims[:, :1], axis=1)) > 0
+
+
+def test_consensus_choices_pairs():
+    a, b = np.array([[1.0, 0.0]]), np.array([[0.0, 1.0]])
+    fs = FeedbackService()
+    # 4o/mistral agreeing picks the 4o answer, llama/mistral the llama answer
+    assert fs.consensus_choices(a, b, a)[0].tolist() == [CONSENSUS_4O]
+    assert fs.consensus_choices(b, a, a)[0].tolist() == [CONSENSUS_LLAMA]
+    # Three identical answers tie on every pair, so nothing strictly wins
+    assert fs.consensus_choices(a, a, a)[0].tolist() == [CONSENSUS_COMBINE]
+
+
+def test_consensus_choices_ignore_unavailable_models():
+    a, b = np.array([[1.0, 0.0]]), np.array([[0.0, 1.0]])
+    fs = FeedbackService()
+    # Llama agreeing with 4o doesn't count when llama didn't answer
+    choices, pair_sims = fs.consensus_choices(a, a, b, available=(True, False, True))
+    assert choices.tolist() == [CONSENSUS_COMBINE]
+    assert np.isneginf(pair_sims[0, [0, 2]]).all()
+    choices, _ = fs.consensus_choices(a, b, a, available=(True, False, True))
+    assert choices.tolist() == [CONSENSUS_4O]
+
+
+def test_stage_graph_runs_each_stage_once_its_dependencies_finish():
+    # b and c only get past the barrier if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def stage(name, value):
+        def run(**deps):
+            if name in ("b", "c"):
+                barrier.wait()
+            order.append(name)
+            return value + sum(deps.values())
+        return run
+
+    graph = StageGraph()
+    graph.add("a", stage("a", 1))
+    graph.add("b", stage("b", 10), deps=["a"])
+    graph.add("c", stage("c", 100), deps=["a"])
+    graph.add("d", stage("d", 1000), deps=["b", "c"])
+    results = graph.run(max_workers=4)
+
+    assert results == {"a": 1, "b": 11, "c": 101, "d": 1112}
+    assert order[0] == "a" and order[-1] == "d"
+
+
+def test_stage_graph_failure_skips_dependent_stages():
+    ran = []
+
+    def fail():
+        raise ValueError("extraction failed")
+
+    graph = StageGraph()
+    graph.add("extract", fail)
+    graph.add("grade", lambda extract: ran.append("grade"), deps=["extract"])
+    with pytest.raises(ValueError, match="extraction failed"):
+        graph.run(max_workers=2)
+    assert ran == []
+
+
+def test_stage_graph_rejects_undeclared_dependencies():
+    with pytest.raises(ValueError):
+        StageGraph().add("grade", lambda extract: None, deps=["extract"])
+
+
+def test_parse_topic_batch_maps_indexed_entries():
+    answers = [[2, ["Optics "]], [1, ["Cells", "Biology"]], [7, ["Out of range"]], [3, ["ok", 5]]]
+    assert FeedbackService().parse_topic_batch(answers, 3) == [["Cells", "Biology"], ["Optics"], None]
+
+
+def test_parse_topic_batch_accepts_positional_lists():
+    assert FeedbackService().parse_topic_batch([["Cells"], ["Optics"]], 2) == [["Cells"], ["Optics"]]
+    # Unindexed lists can't be attributed when the count doesn't match
+    assert FeedbackService().parse_topic_batch([["Cells"]], 2) == [None, None]
+
+
+def test_parse_topic_batch_extracts_json_from_prose():
+    content = 'Sure! Here are the topics:\n[[1, ["Cells"]], [2, ["Optics"]]]\nLet me know if you need more.'
+    assert FeedbackService().parse_topic_batch([content], 2) == [["Cells"], ["Optics"]]
+    assert FeedbackService().parse_topic_batch(["no topics here"], 2) == [None, None]
+
+
+@pytest.fixture
+def one_slot_limiter(monkeypatch):
+    # One request in flight at a time and no rpm/tpm pressure, so only the waiter order matters
+    monkeypatch.setattr(Config, "RATE_LIMITS", {"default": {"rpm": 6000, "tpm": 10 ** 9}})
+    monkeypatch.setattr(Config, "RATE_LIMIT_INITIAL_CONCURRENCY", 1)
+    return AdaptiveRateLimiter()
+
+
+def wait_for_queued(limiter, model, count):
+    deadline = time.monotonic() + 5
+    while limiter.stats()[model]["queued"] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_rate_limiter_serves_interactive_calls_before_queued_bulk_calls(one_slot_limiter):
+    limiter = one_slot_limiter
+    held = limiter.acquire("gpt-4o", priority=PRIORITY_BULK)
+    granted = []
+
+    def waiter(name, priority):
+        slot = limiter.acquire("gpt-4o", priority=priority)
+        granted.append(name)
+        limiter.release(slot)
+
+    threads = [threading.Thread(target=waiter, args=("bulk", PRIORITY_BULK))]
+    threads[0].start()
+    wait_for_queued(limiter, "gpt-4o", 1)
+    threads.append(threading.Thread(target=waiter, args=("interactive", PRIORITY_INTERACTIVE)))
+    threads[1].start()
+    wait_for_queued(limiter, "gpt-4o", 2)
+
+    limiter.release(held)
+    for thread in threads:
+        thread.join(timeout=5)
+    assert granted == ["interactive", "bulk"]
+
+
+def test_rate_limiter_gives_up_after_max_wait(one_slot_limiter, monkeypatch):
+    monkeypatch.setattr(Config, "RATE_LIMIT_MAX_WAIT", 0.2)
+    limiter = one_slot_limiter
+    held = limiter.acquire("gpt-4o")
+    with pytest.raises(UpstreamThrottled):
+        limiter.acquire("gpt-4o")
+    limiter.release(held)
+    assert limiter.stats()["gpt-4o"]["rejected"] == 1
+    assert limiter.stats()["gpt-4o"]["queued"] == 0
+
+
+def test_plan_keeps_item_order_and_caps_items_per_chunk(monkeypatch):
+    monkeypatch.setattr(Config, "PROMPT_MAX_ITEMS_PER_CHUNK", 3)
+    items = [f"question {i}" for i in range(8)]
+    chunks = PromptPlanner().plan("gpt-4o", "Fix the grammar", items, lambda item: 10)
+
+    assert [len(chunk) for chunk in chunks] == [3, 3, 2]
+    assert [pair for chunk in chunks for pair in chunk] == list(enumerate(items))
+
+
+def test_plan_splits_on_the_model_token_limits(monkeypatch):
+    monkeypatch.setattr(Config, "MODEL_LIMITS", {"default": {"input": 400, "output": 200}})
+    planner = PromptPlanner()
+    items = ["word " * 40] * 6
+    chunks = planner.plan("any-model", "Fix the grammar", items, lambda item: 50)
+
+    assert len(chunks) > 1
+    assert sum(len(chunk) for chunk in chunks) == len(items)
+    for chunk in chunks:
+        assert planner.output_budget("any-model", chunk, lambda item: 50) <= 200
+    # An item too large for any chunk still goes out, on its own
+    assert len(planner.plan("any-model", "Fix", ["word " * 1000], lambda item: 50)) == 1
+
+
+def test_parse_indexed_accepts_only_the_indices_that_were_sent():
+    planner = PromptPlanner()
+    assert planner.parse_indexed('[[0, "a"], [1, "b"]]', [0, 1]) == {0: "a", 1: "b"}
+    assert planner.parse_indexed('```python\n[[1, "b"], [0, None]]\n```', [0, 1]) == {0: "", 1: "b"}
+    assert planner.parse_indexed('Here you go: [["2", "c"]] hope that helps', [2]) == {2: "c"}
+    assert planner.parse_indexed('[[0, "a"]]', [0, 1]) is None
+    assert planner.parse_indexed('[[0, "a"], [0, "b"]]', [0]) is None
+    assert planner.parse_indexed('[[0, "a"], [5, "b"]]', [0]) is None
+    assert planner.parse_indexed('[[0, "a", "extra"]]', [0]) is None
+    assert planner.parse_indexed("I can't help with that.", [0]) is None
+    assert planner.parse_indexed("", [0]) is None
+
+
+def test_grammar_fix_larger_than_the_rpm_budget_is_not_throttled(monkeypatch):
+    # 40 one-item chunks against a limiter admitting 20 requests a second, with a queue wait limit of
+    # 0.5s: sent all at once most chunks would give up waiting, sent in waves none of them has to
+    monkeypatch.setattr(Config, "RATE_LIMIT_MAX_WAIT", 0.5)
+    monkeypatch.setattr(Config, "PROMPT_MAX_ITEMS_PER_CHUNK", 1)
+    monkeypatch.setattr(Config, "PROMPT_CHUNK_CONCURRENCY", 4)
+    limiter = AdaptiveRateLimiter()
+    with limiter._lock:
+        limiter._limiter("gpt-4o").requests = TokenBucket(20.0, 2)
+    monkeypatch.setattr(async_llm_module, "rate_limiter", limiter)
+
+    async def completion_async(self, model, prompt, items, max_tokens=200, validate=None):
+        async def request():
+            return str([[int(item[1:item.index("]")]), "fixed"] for item in items])
+        return await async_llm_module.async_llm.call(model, request)
+    monkeypatch.setattr(FeedbackService, "completion_async", completion_async)
+
+    answers = [f"answer {i}" for i in range(40)]
+    fixed = FeedbackService().chunked_responses("gpt-4o", "Fix the grammar", answers, lambda item: 10)
+
+    assert fixed == ["fixed"] * 40
+    assert limiter.stats()["gpt-4o"]["rejected"] == 0
+
+
+def test_throttled_chunks_fall_back_instead_of_failing_the_call(monkeypatch):
+    monkeypatch.setattr(Config, "PROMPT_MAX_ITEMS_PER_CHUNK", 1)
+
+    async def completion_async(self, model, prompt, items, max_tokens=200, validate=None):
+        if "answer 1" in items[0]:
+            raise UpstreamThrottled("gpt-4o: waited too long")
+        return str([[int(item[1:item.index("]")]), "fixed"] for item in items])
+    monkeypatch.setattr(FeedbackService, "completion_async", completion_async)
+
+    fs = FeedbackService()
+    answers = ["answer 0", "answer 1", "answer 2"]
+    assert fs.chunked_responses("gpt-4o", "Fix", answers, lambda item: 10, fallback=str) == ["fixed", "answer 1", "fixed"]
+    with pytest.raises(UpstreamThrottled):
+        fs.chunked_responses("gpt-4o", "Fix", answers, lambda item: 10)
@@ -18,6 +18,7 @@ function TestGrader() {
     const [error, setError] = useState(null);
     const [loading, setLoading] = useState(false);
     const [feedback, setFeedback] = useState('');
+    const [progress, setProgress] = useState('');
     const location = useLocation();
 
     const handleNavigation = (path) => {
@@ -51,6 +52,7 @@ function TestGrader() {
 
         setError(null);
         setLoading(true);
+        setProgress('');
 
         const formData = new FormData();
         formData.append('document', uploadedFile); // Changed to match backend expectation
@@ -67,8 +69,43 @@ function TestGrader() {
                 throw new Error(errorData.errors || 'Failed to submit form');
             }
 
-            const data = await response.json();
-            setFeedback(data.feedback || 'No feedback available');
+            // Same document graded before: the stored result comes back immediately
+            const submitted = await response.json();
+            if (submitted.cached) {
+                setFeedback(submitted.result?.feedback || 'No feedback available');
+                return;
+            }
+
+            // Grading runs as a background job: follow its progress events until it finishes
+            const { events_url } = submitted;
+            const job = await new Promise((resolve, reject) => {
+                const source = new EventSource(`http://127.0.0.1:5000${events_url}`);
+                const stages = ['ocr', 'labeling', 'grammar_fix', 'model_answers', 'similarity', 'feedback', 'topics'];
+                stages.forEach((stage) => {
+                    source.addEventListener(stage, (e) => {
+                        const data = JSON.parse(e.data);
+                        const page = data.page !== undefined ? ` (page ${data.page + 1})` : '';
+                        setProgress(`${stage.replace('_', ' ')}${page} done after ${data.elapsed.toFixed(1)}s`);
+                        if (data.feedback) setFeedback(data.feedback);
+                    });
+                });
+                source.addEventListener('completed', (e) => {
+                    source.close();
+                    resolve({ status: 'completed', ...JSON.parse(e.data) });
+                });
+                source.addEventListener('failed', (e) => {
+                    source.close();
+                    resolve({ status: 'failed', ...JSON.parse(e.data) });
+                });
+                source.onerror = () => {
+                    if (source.readyState === EventSource.CLOSED) reject(new Error('Lost connection to the grader'));
+                };
+            });
+
+            if (job.status === 'failed') {
+                throw new Error(job.error || 'Grading failed');
+            }
+            setFeedback(job.result?.feedback || 'No feedback available');
         } catch (err) {
             setError(err.message || 'An error occurred while submitting the form.');
             console.error(err);
@@ -197,6 +234,12 @@ function TestGrader() {
                         Submit
                     </button>
 
+                    {loading && progress && (
+                        <div className="mt-4 p-4 text-gray-300 border border-gray-700 rounded-lg">
+                            {progress}
+                        </div>
+                    )}
+
                     {error && (
                         <div className="mt-4 p-4 text-red-700 bg-red-100 border border-red-300 rounded-lg">
                             {error}